@@ -1,5 +1,6 @@
 # bot.py
 
+import asyncio
 import logging
 import json
 from datetime import datetime
@@ -33,7 +34,13 @@ from handlers.feedback import (
 )
 from config import BOT_TOKEN, WORK_START_HOUR, WORK_END_HOUR, ADMIN_ID
 from handlers.mongo import initialize_database, close_client
+from handlers.breaker import mongo_breaker
 from handlers.notification import NotificationChecker
+from handlers.availability import AvailabilityWatcher
+from handlers.cart_store import temp_cart_store
+from handlers.outbox import outbox_relay
+from handlers.journal import order_journal
+from handlers.reconciler import OrderReconciler
 from handlers.catalog import SAMSA_KEYS, PACKAGING_KEYS
 import os
 
@@ -218,6 +225,31 @@ async def contact_handler(update, context):
     except Exception as e:
         logging.error(f"Error in contact_handler: {e}")
 
+async def start_mongo_services(application):
+    """Start the background services that need MongoDB (once per process)."""
+    if not hasattr(application, 'notification_checker'):
+        try:
+            # Polling interval adapts to the queue (see NOTIFICATION_*_INTERVAL)
+            notification_checker = NotificationChecker(
+                application.bot,
+                bot_data=application.bot_data
+            )
+            await notification_checker.start()
+            # Store reference for cleanup
+            application.notification_checker = notification_checker
+            print("✅ Notification checker started")
+        except Exception as e:
+            print(f"⚠️ Notification checker failed to start: {e}")
+
+    if not hasattr(application, 'outbox_relay'):
+        try:
+            if await outbox_relay.start():
+                application.outbox_relay = outbox_relay
+                print("✅ Outbox relay started")
+        except Exception as e:
+            print(f"⚠️ Outbox relay failed to start: {e}")
+
+
 def main():
     # 1) init texts, keyboards, availability (after DB init)
     async def _startup(application):
@@ -227,53 +259,86 @@ def main():
         except Exception as e:
             print(f"⚠️ MongoDB initialization failed: {e}")
             print("🔄 Bot will run in fallback mode with limited functionality")
-            # Set a flag to indicate fallback mode
-            application.bot_data['mongodb_available'] = False
-        else:
-            application.bot_data['mongodb_available'] = True
+            # Fallback mode until a half-open probe reaches MongoDB again
+            mongo_breaker.trip()
+        # The circuit breaker owns bot_data['mongodb_available']
+        mongo_breaker.bind(application.bot_data)
             
         await init_bot_data(application)
         
         # Set bot commands (blue menu) - only essential commands
-        try:
-            commands = [
-                BotCommand("start", "🏠 Главное меню"),
-                BotCommand("order", "🛒 Сделать заказ"),
-            ]
-            await application.bot.set_my_commands(commands)
-            print("✅ Bot commands set successfully")
-        except Exception as e:
-            print(f"⚠️ Failed to set bot commands: {e}")
+        async def set_commands():
+            try:
+                commands = [
+                    BotCommand("start", "🏠 Главное меню"),
+                    BotCommand("order", "🛒 Сделать заказ"),
+                ]
+                await application.bot.set_my_commands(commands)
+                print("✅ Bot commands set successfully")
+            except Exception as e:
+                print(f"⚠️ Failed to set bot commands: {e}")
         
         # Preload images for instant loading
-        try:
-            await preload_images(application.bot, application.bot_data)
-        except Exception as e:
-            print(f"⚠️ Image preload failed: {e}")
-            print("🔄 Images will be loaded on-demand")
-            application.bot_data['photo_cache'] = {}
+        async def load_images():
+            try:
+                await preload_images(application.bot, application.bot_data)
+            except Exception as e:
+                print(f"⚠️ Image preload failed: {e}")
+                print("🔄 Images will be loaded on-demand")
+                application.bot_data['photo_cache'] = {}
+
+        # Independent Telegram calls; don't pay for them one after another
+        await asyncio.gather(set_commands(), load_images())
         
         # Start notification checker only if MongoDB is available
         if application.bot_data.get('mongodb_available', False):
-            try:
-                notification_checker = NotificationChecker(
-                    application.bot, 
-                    interval=30,
-                    bot_data=application.bot_data
-                )
-                await notification_checker.start()
-                # Store reference for cleanup
-                application.notification_checker = notification_checker
-                print("✅ Notification checker started (with availability refresh)")
-            except Exception as e:
-                print(f"⚠️ Notification checker failed to start: {e}")
+            await start_mongo_services(application)
         else:
             print("⚠️ Notification checker disabled - MongoDB not available")
 
+        # Retries with backoff, so it also picks up a MongoDB that recovers later
+        try:
+            availability_watcher = AvailabilityWatcher(application.bot_data)
+            await availability_watcher.start()
+            application.availability_watcher = availability_watcher
+            print("✅ Availability watcher started")
+        except Exception as e:
+            print(f"⚠️ Availability watcher failed to start: {e}")
+
+        # Replays orders journaled during outages (also when started offline)
+        # and starts the services above once MongoDB comes back
+        try:
+            order_reconciler = OrderReconciler(
+                application.bot_data,
+                on_reconnect=lambda: start_mongo_services(application),
+            )
+            await order_reconciler.start()
+            application.order_reconciler = order_reconciler
+        except Exception as e:
+            print(f"⚠️ Order reconciler failed to start: {e}")
+
     async def _shutdown(application):
         # Stop notification checker
         if hasattr(application, 'notification_checker'):
             await application.notification_checker.stop()
+
+        # Stop availability watcher
+        if hasattr(application, 'availability_watcher'):
+            await application.availability_watcher.stop()
+
+        # Stop outbox relay
+        if hasattr(application, 'outbox_relay'):
+            await application.outbox_relay.stop()
+
+        # Flush carts still waiting in the write-behind buffer
+        await temp_cart_store.close()
+
+        # Stop offline order replay
+        if hasattr(application, 'order_reconciler'):
+            await application.order_reconciler.stop()
+
+        # Finish journal writes of orders taken without MongoDB
+        await order_journal.close()
         
         # Close MongoDB client
         close_client()
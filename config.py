@@ -34,6 +34,17 @@ DATA_DIR = os.path.join(BASE_DIR, 'data')
 REVIEWS_FILE     = os.path.join(DATA_DIR, 'reviews.json')
 AVAILABILITY_FILE = os.path.join(DATA_DIR, 'availability.json')
 ORDERS_DB        = os.path.join(DATA_DIR, 'orders.json')
+# Orders taken while MongoDB is unavailable (append-only JSONL)
+ORDERS_JOURNAL   = os.getenv('ORDERS_JOURNAL', os.path.join(DATA_DIR, 'orders_journal.jsonl'))
+# Appends arriving within this many seconds share one fsync
+ORDER_JOURNAL_COMMIT_DELAY = float(os.getenv('ORDER_JOURNAL_COMMIT_DELAY', '0.002'))
+# Journaled orders are replayed into MongoDB in the background once it is reachable
+ORDERS_JOURNAL_CHECKPOINT = os.getenv('ORDERS_JOURNAL_CHECKPOINT', ORDERS_JOURNAL + '.checkpoint')
+ORDER_REPLAY_INTERVAL = float(os.getenv('ORDER_REPLAY_INTERVAL', '10'))
+ORDER_REPLAY_BATCH = int(os.getenv('ORDER_REPLAY_BATCH', '500'))
+# Streaming import of the legacy orders.json (python -m handlers.legacy_import)
+LEGACY_IMPORT_CHECKPOINT = os.getenv('LEGACY_IMPORT_CHECKPOINT', ORDERS_DB + '.import-checkpoint')
+LEGACY_IMPORT_BATCH = int(os.getenv('LEGACY_IMPORT_BATCH', '1000'))
 
 # MongoDB (support both MONGO_URI and MONGODB_URI)
 MONGO_URI = os.getenv('MONGO_URI') or os.getenv('MONGODB_URI')
@@ -43,7 +54,96 @@ MONGO_COLLECTION_REVIEWS = os.getenv('MONGO_COLLECTION_REVIEWS', 'reviews')
 MONGO_COLLECTION_AVAILABILITY = os.getenv('MONGO_COLLECTION_AVAILABILITY', 'availability')
 MONGO_COLLECTION_PRODUCTS = os.getenv('MONGO_COLLECTION_PRODUCTS', 'inventory')
 MONGO_COLLECTION_NOTIFICATIONS = os.getenv('MONGO_COLLECTION_NOTIFICATIONS', 'notifications')
+MONGO_COLLECTION_NOTIFICATIONS_DEAD = os.getenv('MONGO_COLLECTION_NOTIFICATIONS_DEAD', 'notifications_dead')
 MONGO_COLLECTION_TEMP_CARTS = os.getenv('MONGO_COLLECTION_TEMP_CARTS', 'temp_carts')
+MONGO_COLLECTION_OUTBOX = os.getenv('MONGO_COLLECTION_OUTBOX', 'outbox')
+MONGO_COLLECTION_USER_STATS = os.getenv('MONGO_COLLECTION_USER_STATS', 'user_stats')
+MONGO_COLLECTION_META = os.getenv('MONGO_COLLECTION_META', 'meta')
+
+# Storage backend: 'mongo' (MongoDB), 'sqlite' (local file, WAL mode) or 'memory'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(DATA_DIR, 'orders.db'))
+
+# Startup probes every connection profile with a ping and keeps the fastest;
+# its pool is pre-warmed to MONGO_MIN_POOL_SIZE connections
+MONGO_PROBE_TIMEOUT = float(os.getenv('MONGO_PROBE_TIMEOUT', '10'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '2'))
+
+# Circuit breaker around MongoDB calls: opens when failed or slow calls
+# reach BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls
+MONGO_OPERATION_TIMEOUT = float(os.getenv('MONGO_OPERATION_TIMEOUT', '5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', '2'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '15'))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv('BREAKER_HALF_OPEN_PROBES', '1'))
+# Index builds and bulk imports/replays: no slow-call rule, own timeout (0 = none)
+MONGO_MAINTENANCE_TIMEOUT = float(os.getenv('MONGO_MAINTENANCE_TIMEOUT', '0'))
+
+# Availability watcher (change stream, with polling fallback)
+AVAILABILITY_POLL_INTERVAL = float(os.getenv('AVAILABILITY_POLL_INTERVAL', '5'))
+AVAILABILITY_MAX_BACKOFF = float(os.getenv('AVAILABILITY_MAX_BACKOFF', '300'))
+AVAILABILITY_CACHE_TTL = float(os.getenv('AVAILABILITY_CACHE_TTL', '10'))
+
+# Temp carts are written behind; dirty carts are flushed in one bulk_write
+TEMP_CART_FLUSH_INTERVAL = float(os.getenv('TEMP_CART_FLUSH_INTERVAL', '0.5'))
+# Failed flushes are retried with exponential backoff up to this many seconds
+TEMP_CART_MAX_BACKOFF = float(os.getenv('TEMP_CART_MAX_BACKOFF', '60'))
+# Read-through LRU of recent temp carts
+TEMP_CART_CACHE_SIZE = int(os.getenv('TEMP_CART_CACHE_SIZE', '5000'))
+TEMP_CART_CACHE_IDLE = float(os.getenv('TEMP_CART_CACHE_IDLE', '1800'))
+TEMP_CART_PREFETCH = os.getenv('TEMP_CART_PREFETCH', 'true').lower() in ('1', 'true', 'yes')
+
+# Run order status change + notification insert in one transaction on replica sets
+ORDER_STATUS_TRANSACTIONS = os.getenv('ORDER_STATUS_TRANSACTIONS', 'true').lower() in ('1', 'true', 'yes')
+
+# Upper bound for each secondary step after an order is confirmed
+# (temp cart cleanup, outbox event, user stats)
+ORDER_SIDE_EFFECT_TIMEOUT = float(os.getenv('ORDER_SIDE_EFFECT_TIMEOUT', '5'))
+
+# Notification delivery (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+NOTIFICATION_GLOBAL_RATE = float(os.getenv('NOTIFICATION_GLOBAL_RATE', '30'))
+NOTIFICATION_PER_CHAT_RATE = float(os.getenv('NOTIFICATION_PER_CHAT_RATE', '1'))
+NOTIFICATION_WORKERS = int(os.getenv('NOTIFICATION_WORKERS', '16'))
+NOTIFICATION_MAX_FLOOD_RETRIES = int(os.getenv('NOTIFICATION_MAX_FLOOD_RETRIES', '3'))
+# Delivery acks are logged locally, then written to MongoDB in batches. One log
+# per process so replicas on one host don't share it; logs of processes that
+# are gone are replayed by the next one to start.
+NOTIFICATION_ACK_LOG = os.getenv('NOTIFICATION_ACK_LOG', os.path.join(DATA_DIR, f'notification_acks.{os.getpid()}.jsonl'))
+NOTIFICATION_ACK_BATCH_SIZE = int(os.getenv('NOTIFICATION_ACK_BATCH_SIZE', '100'))
+NOTIFICATION_ACK_FLUSH_INTERVAL = float(os.getenv('NOTIFICATION_ACK_FLUSH_INTERVAL', '1'))
+# Notifications are claimed under a lease so several bot replicas can share the queue
+NOTIFICATION_LEASE_SECONDS = float(os.getenv('NOTIFICATION_LEASE_SECONDS', '300'))
+NOTIFICATION_CLAIM_BATCH = int(os.getenv('NOTIFICATION_CLAIM_BATCH', '100'))
+NOTIFICATION_MAX_PER_TICK = int(os.getenv('NOTIFICATION_MAX_PER_TICK', '500'))
+# Share of each claim batch reserved for the newest notifications
+NOTIFICATION_FRESH_SHARE = float(os.getenv('NOTIFICATION_FRESH_SHARE', '0.2'))
+# Failed deliveries are retried with exponential backoff, then dead-lettered
+NOTIFICATION_RETRY_BASE = float(os.getenv('NOTIFICATION_RETRY_BASE', '30'))
+NOTIFICATION_RETRY_MAX = float(os.getenv('NOTIFICATION_RETRY_MAX', '3600'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '8'))
+# Adaptive polling: fast while busy, backing off to the max interval when idle;
+# the max bounds the latency of notifications queued by other processes
+NOTIFICATION_MIN_INTERVAL = float(os.getenv('NOTIFICATION_MIN_INTERVAL', '0.5'))
+NOTIFICATION_MAX_INTERVAL = float(os.getenv('NOTIFICATION_MAX_INTERVAL', '30'))
+NOTIFICATION_POLL_JITTER = float(os.getenv('NOTIFICATION_POLL_JITTER', '0.2'))
+
+# Order events (outbox) pushed to the kitchen/admin side
+# Subscribers: an HTTP webhook, optionally reached over a Unix socket
+OUTBOX_WEBHOOK_URL = os.getenv('OUTBOX_WEBHOOK_URL', '')
+OUTBOX_SOCKET_PATH = os.getenv('OUTBOX_SOCKET_PATH', '')
+OUTBOX_TIMEOUT = float(os.getenv('OUTBOX_TIMEOUT', '5'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '30'))
+# Events of a claimed batch delivered at once; keep BATCH_SIZE / CONCURRENCY * TIMEOUT under the lease
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '20'))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '1'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '300'))
+# Delivered events are removed by a TTL index this many days after delivery
+# (without a webhook/socket subscriber, events count as delivered when written)
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
 
 # Business information
 BUSINESS_NAME = "Самсария"
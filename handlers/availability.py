@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from typing import Optional, Dict, Any
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from config import AVAILABILITY_POLL_INTERVAL, AVAILABILITY_MAX_BACKOFF
+from .mongo import get_availability_collection, parse_availability_doc, availability_cache
+
+logger = logging.getLogger(__name__)
+
+# Server error codes meaning change streams can never work on this deployment
+# (standalone server, or a tier without $changeStream support).
+_CHANGE_STREAM_UNSUPPORTED_CODES = {40573, 115, 20}
+# Resume token is no longer in the oplog; the stream must restart from "now".
+_CHANGE_STREAM_HISTORY_LOST_CODES = {280, 286}
+
+
+def _change_streams_unsupported(error: OperationFailure) -> bool:
+    if error.code in _CHANGE_STREAM_UNSUPPORTED_CODES:
+        return True
+    return 'only supported on replica sets' in str(error)
+
+
+class AvailabilityWatcher:
+    """Background task that keeps bot_data['avail'] in sync with the admin bot.
+
+    Subscribes to a MongoDB change stream on the availability document so an
+    admin toggle reaches customers almost immediately. Deployments without
+    change streams fall back to polling; errors in either mode back off
+    exponentially up to ``max_backoff`` seconds.
+    """
+
+    def __init__(
+        self,
+        bot_data: Dict[str, Any],
+        poll_interval: float = AVAILABILITY_POLL_INTERVAL,
+        max_backoff: float = AVAILABILITY_MAX_BACKOFF,
+    ):
+        self.bot_data = bot_data
+        if bot_data is not None:
+            availability_cache.bind(bot_data)
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.mode = 'change_stream'
+        self._resume_token: Optional[Dict[str, Any]] = None
+        self._poll_token: Any = None
+        self._failures = 0
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    async def start(self) -> None:
+        """Start the availability watcher background task."""
+        if self._running:
+            return
+
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info("Availability watcher started")
+
+    async def stop(self) -> None:
+        """Stop the availability watcher background task."""
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logger.info("Availability watcher stopped")
+
+    def _backoff_delay(self) -> float:
+        return min(self.poll_interval * (2 ** (self._failures - 1)), self.max_backoff)
+
+    def _apply(self, availability: Dict[str, bool]) -> None:
+        """Publish a fresh availability map to the cache (and bot_data)."""
+        if availability:
+            snapshot = availability_cache.publish(availability)
+            logger.debug(f"Availability updated: v{snapshot.version}, {len(snapshot)} items")
+
+    async def _refresh(self) -> None:
+        await availability_cache.refresh()
+
+    async def _watch(self) -> None:
+        """Follow the change stream until it fails or the watcher stops."""
+        col = get_availability_collection()
+        pipeline = [{'$match': {'documentKey._id': 'availability'}}]
+        async with col.watch(
+            pipeline,
+            full_document='updateLookup',
+            resume_after=self._resume_token,
+        ) as stream:
+            if self._resume_token is None:
+                # Load the current state only after the stream is open so an
+                # admin write between the read and the subscription is not lost
+                await self._refresh()
+            self._failures = 0
+            logger.info("Availability change stream opened")
+            async for change in stream:
+                self._resume_token = stream.resume_token
+                doc = change.get('fullDocument')
+                if doc is not None:
+                    self._apply(parse_availability_doc(doc))
+                elif change.get('operationType') != 'delete':
+                    await self._refresh()
+        # The stream only ends on invalidate; its token cannot be resumed
+        self._resume_token = None
+
+    async def _poll(self) -> None:
+        """Fallback for deployments without change streams."""
+        doc = await get_availability_collection().find_one({'_id': 'availability'})
+        self._failures = 0
+        # synced_at acts as the polling resume token: skip unchanged documents
+        token = doc.get('synced_at') if isinstance(doc, dict) else None
+        if token is not None and token == self._poll_token:
+            return
+        self._poll_token = token
+        availability = parse_availability_doc(doc)
+        if availability:
+            self._apply(availability)
+        else:
+            await self._refresh()
+
+    async def _run(self) -> None:
+        """Main loop: change stream first, polling when unsupported."""
+        while self._running:
+            try:
+                if self.mode == 'change_stream':
+                    await self._watch()
+                else:
+                    await self._poll()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+            except asyncio.CancelledError:
+                break
+            except OperationFailure as e:
+                if self.mode == 'change_stream' and _change_streams_unsupported(e):
+                    logger.warning(f"Change streams unavailable, polling availability every {self.poll_interval}s: {e}")
+                    self.mode = 'polling'
+                    self._resume_token = None
+                    continue
+                if e.code in _CHANGE_STREAM_HISTORY_LOST_CODES:
+                    logger.warning("Availability resume token expired, restarting change stream")
+                    self._resume_token = None
+                    continue
+                self._failures += 1
+                logger.error(f"Availability watcher error: {e}")
+            except PyMongoError as e:
+                self._failures += 1
+                logger.error(f"Availability watcher error: {e}")
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"Unexpected error in availability watcher: {e}")
+
+            if self._failures == 0:
+                # Stream closed cleanly (e.g. invalidate); reopen right away
+                continue
+            try:
+                await asyncio.sleep(self._backoff_delay())
+            except asyncio.CancelledError:
+                break
@@ -0,0 +1,281 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Dict, Any
+
+from pymongo.errors import ConnectionFailure, NetworkTimeout
+
+from config import (
+    BREAKER_WINDOW,
+    BREAKER_MIN_CALLS,
+    BREAKER_FAILURE_RATE,
+    BREAKER_SLOW_CALL_SECONDS,
+    BREAKER_OPEN_SECONDS,
+    BREAKER_HALF_OPEN_PROBES,
+    MONGO_OPERATION_TIMEOUT,
+    MONGO_MAINTENANCE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(ConnectionFailure):
+    """Raised instead of calling MongoDB while the circuit is open."""
+
+
+_maintenance: ContextVar[bool] = ContextVar('mongo_maintenance', default=False)
+
+
+@contextmanager
+def maintenance():
+    """Run bulk maintenance work (imports, replays) on the maintenance budget.
+
+    Calls made inside, including from tasks started inside, skip the
+    slow-call rule and use ``maintenance_timeout`` instead of
+    ``call_timeout``. Connection failures still count.
+    """
+    token = _maintenance.set(True)
+    try:
+        yield
+    finally:
+        _maintenance.reset(token)
+
+
+class CircuitBreaker:
+    """Tracks MongoDB health from the outcome and latency of every call.
+
+    While closed, the last ``window`` calls are kept. Once at least
+    ``min_calls`` are recorded and the share of failed or slow calls
+    reaches ``failure_rate``, the breaker opens. Calls then fail at once
+    with CircuitOpenError. After ``open_seconds``, up to
+    ``half_open_probes`` calls go through as probes. A healthy probe closes
+    the breaker; a failed or slow one reopens it.
+
+    Only connection problems and timeouts count as failures. A server that
+    answers with an error (e.g. a duplicate key) is healthy. Index DDL and
+    work run under ``maintenance()`` is legitimately slow: it gets
+    ``maintenance_timeout`` and never counts as a slow call. When bound to
+    ``bot_data``, ``bot_data['mongodb_available']`` follows the breaker: it
+    is False unless the breaker is closed.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES,
+        call_timeout: float = MONGO_OPERATION_TIMEOUT,
+        maintenance_timeout: float = MONGO_MAINTENANCE_TIMEOUT,
+    ):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.call_timeout = call_timeout
+        self.maintenance_timeout = maintenance_timeout
+        self.state = self.CLOSED
+        self._outcomes: deque = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._bot_data: Optional[Dict[str, Any]] = None
+
+    def bind(self, bot_data: Dict[str, Any]) -> None:
+        """Drive ``bot_data['mongodb_available']`` from now on."""
+        self._bot_data = bot_data
+        bot_data['mongodb_available'] = self.state == self.CLOSED
+
+    def trip(self) -> None:
+        """Open the circuit now, e.g. when MongoDB was unreachable at startup."""
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"MongoDB circuit {self.state} -> {state}")
+        self.state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if state != self.HALF_OPEN:
+            self._probes = 0
+        if state == self.CLOSED:
+            self._outcomes.clear()
+        if self._bot_data is not None:
+            self._bot_data['mongodb_available'] = state == self.CLOSED
+
+    def allow(self) -> bool:
+        """Whether a call may go to MongoDB now (reserves a probe when half-open)."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                return False
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                return False
+            self._probes += 1
+        return True
+
+    def record(self, failed: bool, elapsed: float, probe: bool = False) -> None:
+        bad = failed or elapsed >= self.slow_call_seconds
+        if probe:
+            self._probes = max(self._probes - 1, 0)
+            if self.state == self.HALF_OPEN:
+                self._set_state(self.OPEN if bad else self.CLOSED)
+            return
+        if self.state != self.CLOSED:
+            return
+        self._outcomes.append(bad)
+        if len(self._outcomes) >= self.min_calls:
+            if sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._set_state(self.OPEN)
+
+    async def call(self, func, *args, **kwargs):
+        """Await ``func(*args, **kwargs)`` under the breaker."""
+        return await self._call(func, args, kwargs, _maintenance.get())
+
+    async def call_maintenance(self, func, *args, **kwargs):
+        """Like ``call``, on the maintenance budget (index DDL)."""
+        return await self._call(func, args, kwargs, True)
+
+    async def _call(self, func, args, kwargs, maintenance: bool):
+        if not self.allow():
+            raise CircuitOpenError('MongoDB circuit is open, failing fast')
+        probe = self.state == self.HALF_OPEN
+        timeout = self.maintenance_timeout if maintenance else self.call_timeout
+        started = time.monotonic()
+
+        def elapsed() -> float:
+            # Maintenance work is slow by nature; only its failures count
+            return 0.0 if maintenance else time.monotonic() - started
+
+        try:
+            if timeout:
+                result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+            else:
+                result = await func(*args, **kwargs)
+        except asyncio.TimeoutError:
+            self.record(True, elapsed(), probe)
+            raise NetworkTimeout(f"MongoDB call timed out after {timeout}s")
+        except ConnectionFailure:
+            self.record(True, elapsed(), probe)
+            raise
+        except asyncio.CancelledError:
+            if probe:
+                self._probes = max(self._probes - 1, 0)
+            raise
+        except Exception:
+            # The server answered; that is a healthy connection
+            self.record(False, elapsed(), probe)
+            raise
+        self.record(False, elapsed(), probe)
+        return result
+
+
+# Collection methods that talk to the server
+_GUARDED_METHODS = frozenset({
+    'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+    'delete_one', 'delete_many', 'find_one_and_update', 'find_one_and_replace',
+    'find_one_and_delete', 'count_documents', 'estimated_document_count', 'bulk_write',
+    'index_information', 'distinct',
+})
+# DDL: index builds can take minutes, always on the maintenance budget
+_MAINTENANCE_METHODS = frozenset({'create_index', 'create_indexes', 'drop_index', 'drop'})
+
+
+class GuardedCursor:
+    """Cursor whose fetches go through the breaker; chaining works as usual.
+
+    ``async for`` fetches one batch per breaker call, so the timeout and the
+    memory held apply to a batch, not to the whole result set.
+    """
+
+    DEFAULT_BATCH = 101
+
+    def __init__(self, cursor, breaker: CircuitBreaker):
+        self._cursor = cursor
+        self._breaker = breaker
+        self._batch = self.DEFAULT_BATCH
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def chained(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+        return chained
+
+    def batch_size(self, size: int) -> 'GuardedCursor':
+        self._cursor.batch_size(size)
+        self._batch = size or self.DEFAULT_BATCH
+        return self
+
+    async def to_list(self, length=None):
+        return await self._breaker.call(self._cursor.to_list, length)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            batch = await self.to_list(self._batch)
+            if not batch:
+                return
+            for doc in batch:
+                yield doc
+
+
+class GuardedCollection:
+    """Collection proxy putting every server call behind the breaker."""
+
+    def __init__(self, collection, breaker: CircuitBreaker):
+        self._collection = collection
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in _GUARDED_METHODS:
+            async def guarded(*args, **kwargs):
+                return await self._breaker.call(attr, *args, **kwargs)
+            return guarded
+        if name in _MAINTENANCE_METHODS:
+            async def maintained(*args, **kwargs):
+                return await self._breaker.call_maintenance(attr, *args, **kwargs)
+            return maintained
+        if name in ('find', 'aggregate'):
+            def cursor(*args, **kwargs):
+                return GuardedCursor(attr(*args, **kwargs), self._breaker)
+            return cursor
+        # watch() and plain attributes pass through
+        return attr
+
+
+class GuardedDatabase:
+    def __init__(self, database, breaker: CircuitBreaker):
+        self._database = database
+        self._breaker = breaker
+
+    def __getitem__(self, name: str) -> GuardedCollection:
+        return GuardedCollection(self._database[name], self._breaker)
+
+    def __getattr__(self, name):
+        attr = getattr(self._database, name)
+        if name == 'command':
+            async def command(*args, **kwargs):
+                return await self._breaker.call(attr, *args, **kwargs)
+            return command
+        return attr
+
+
+mongo_breaker = CircuitBreaker()
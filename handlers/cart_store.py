@@ -0,0 +1,185 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+from pymongo import UpdateOne, DeleteOne
+
+from config import TEMP_CART_FLUSH_INTERVAL, TEMP_CART_MAX_BACKOFF, TEMP_CART_CACHE_SIZE, TEMP_CART_CACHE_IDLE
+from .mongo import get_temp_carts_collection
+
+logger = logging.getLogger(__name__)
+
+
+class TempCartStore:
+    """Write-behind buffer for the temp_carts collection.
+
+    Handlers record the newest cart per user in memory and return at once;
+    dirty carts are written as one unordered bulk_write after
+    ``flush_interval`` seconds, so a burst of edits costs a single round trip.
+    A pending value of None means the cart is to be deleted. A failed flush
+    keeps the carts queued and is retried with exponential backoff up to
+    ``max_backoff`` seconds.
+
+    Reads go through an LRU of recent carts (bounded by ``max_entries`` and
+    ``idle_ttl`` seconds without access). Known-empty carts are cached too,
+    so the first order tap of a user without a cart needs no database read.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = TEMP_CART_FLUSH_INTERVAL,
+        max_backoff: float = TEMP_CART_MAX_BACKOFF,
+        max_entries: int = TEMP_CART_CACHE_SIZE,
+        idle_ttl: float = TEMP_CART_CACHE_IDLE,
+    ):
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self._failures = 0
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._dirty: Dict[int, Optional[Dict[str, Any]]] = {}
+        # user_id -> (cart doc or None when the user has no cart, last access)
+        self._cache: "OrderedDict[int, Tuple[Optional[Dict[str, Any]], float]]" = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._closing = False
+
+    def save(self, user_id: int, cart_doc: Dict[str, Any]) -> None:
+        """Queue an upsert of the user's cart document."""
+        self._dirty[user_id] = cart_doc
+        self._remember(user_id, cart_doc)
+        self._schedule_flush()
+
+    def delete(self, user_id: int) -> None:
+        """Queue deletion of the user's cart."""
+        self._dirty[user_id] = None
+        self._remember(user_id, None)
+        self._schedule_flush()
+
+    def _remember(self, user_id: int, cart_doc: Optional[Dict[str, Any]]) -> None:
+        now = time.monotonic()
+        self._cache[user_id] = (cart_doc, now)
+        self._cache.move_to_end(user_id)
+        while self._cache:
+            oldest_id, (_, last_access) = next(iter(self._cache.items()))
+            if len(self._cache) <= self.max_entries and now - last_access < self.idle_ttl:
+                break
+            del self._cache[oldest_id]
+
+    def _cached(self, user_id: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return False, None
+        cart_doc, last_access = entry
+        now = time.monotonic()
+        if now - last_access >= self.idle_ttl:
+            del self._cache[user_id]
+            return False, None
+        self._cache[user_id] = (cart_doc, now)
+        self._cache.move_to_end(user_id)
+        return True, cart_doc
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return the user's cart document (None if absent), reading MongoDB only on a miss."""
+        has_pending, cart_doc = self.pending(user_id)
+        if has_pending:
+            return cart_doc
+        hit, cart_doc = self._cached(user_id)
+        if hit:
+            return cart_doc
+        future = self._loading.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(user_id))
+            self._loading[user_id] = future
+            future.add_done_callback(lambda _f: self._loading.pop(user_id, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, user_id: int) -> Optional[Dict[str, Any]]:
+        cart_doc = await get_temp_carts_collection().find_one({'user_id': user_id})
+        # A save/delete that raced with the read wins over the stale result
+        hit, newer = self._cached(user_id)
+        if hit:
+            return newer
+        self._remember(user_id, cart_doc)
+        return cart_doc
+
+    def prefetch(self, user_id: int) -> None:
+        """Warm the cache for a user in the background."""
+        if user_id in self._dirty or user_id in self._loading or user_id in self._cache:
+            return
+        future = asyncio.ensure_future(self.load(user_id))
+        future.add_done_callback(self._log_prefetch_error)
+
+    @staticmethod
+    def _log_prefetch_error(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug(f"Temp cart prefetch failed: {future.exception()}")
+
+    def pending(self, user_id: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Return (True, doc) if the user has an unflushed write; doc is None for a delete."""
+        if user_id in self._dirty:
+            return True, self._dirty[user_id]
+        return False, None
+
+    def _schedule_flush(self) -> None:
+        if self._closing:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _flush_delay(self) -> float:
+        if not self._failures:
+            return self.flush_interval
+        return min(self.flush_interval * (2 ** self._failures), self.max_backoff)
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self._flush_delay())
+        except asyncio.CancelledError:
+            return
+        # Clear the handle first so writes during the flush schedule a new one
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write all dirty carts in one bulk_write."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            ops = []
+            for user_id, cart_doc in batch.items():
+                if cart_doc is None:
+                    ops.append(DeleteOne({'user_id': user_id}))
+                else:
+                    ops.append(UpdateOne({'user_id': user_id}, {'$set': cart_doc}, upsert=True))
+            try:
+                await get_temp_carts_collection().bulk_write(ops, ordered=False)
+                logger.debug(f"Flushed {len(ops)} temp cart writes")
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                logger.error(
+                    f"Error flushing temp carts ({len(ops)} pending, retry in {self._flush_delay():.1f}s): {e}"
+                )
+                # Requeue, keeping any newer write made while flushing
+                for user_id, cart_doc in batch.items():
+                    self._dirty.setdefault(user_id, cart_doc)
+        if self._dirty:
+            self._schedule_flush()
+
+    async def close(self) -> None:
+        """Cancel the pending timer and flush everything (called on shutdown)."""
+        self._closing = True
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        await self.flush()
+        if self._dirty:
+            logger.warning(f"{len(self._dirty)} temp carts could not be flushed on shutdown")
+
+
+temp_cart_store = TempCartStore()
@@ -3,8 +3,9 @@
 import json
 from telegram import ReplyKeyboardMarkup
 from telegram.ext import ContextTypes
-from config import AVAILABILITY_FILE
-from .mongo import get_availability_dict, get_availability_collection
+from config import AVAILABILITY_FILE, TEMP_CART_PREFETCH
+from .mongo import get_availability_dict, get_availability_collection, availability_cache
+from .cart_store import temp_cart_store
 
 LANGUAGES = ['ru', 'uz']
 
@@ -256,6 +257,8 @@ async def init_bot_data(app):
     # Try to get availability from MongoDB, fallback to local file
     try:
         if app.bot_data.get('mongodb_available', True):
+            # The cache keeps bot_data['avail'] on its latest snapshot
+            availability_cache.bind(app.bot_data)
             app.bot_data['avail'] = await get_availability_dict()
         else:
             # Fallback to local file
@@ -297,6 +300,7 @@ def load_local_availability():
 async def set_availability_item(key: str, is_enabled: bool) -> None:
     col = get_availability_collection()
     await col.update_one({'_id': 'availability'}, {'$set': {f'items.{key}': bool(is_enabled)}})
+    await availability_cache.refresh()
 
 async def get_availability() -> dict:
     return await get_availability_dict()
@@ -404,6 +408,9 @@ async def help_command(update, context: ContextTypes.DEFAULT_TYPE):
 
 async def main_menu(update, context: ContextTypes.DEFAULT_TYPE):
     t = context.bot_data['texts']
+    # Warm the temp cart cache so the next order tap needs no DB read
+    if TEMP_CART_PREFETCH and update.effective_user and context.bot_data.get('mongodb_available', True):
+        temp_cart_store.prefetch(update.effective_user.id)
     await update.message.reply_text(t['welcome'], reply_markup=context.bot_data['keyb']['main'])
 
 def get_text(context, key):
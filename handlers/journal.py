@@ -0,0 +1,127 @@
+import os
+import uuid
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+
+from bson import json_util
+
+from config import ORDERS_JOURNAL, ORDER_JOURNAL_COMMIT_DELAY
+
+logger = logging.getLogger(__name__)
+
+
+class OrderJournal:
+    """Append-only JSONL journal of orders taken while MongoDB is unavailable.
+
+    Each order is one line of MongoDB extended JSON, so appending costs the
+    same no matter how many orders came before. Appends are group-committed:
+    orders confirmed within ``commit_delay`` seconds of each other are written
+    and fsynced together, and every append returns only once its line is on
+    disk. File I/O runs in a worker thread, never on the event loop.
+
+    A line torn by a crash mid-write is cut off before the next append, and
+    ``read`` stops at it, so replay only ever sees complete records.
+    """
+
+    def __init__(self, path: str = ORDERS_JOURNAL, commit_delay: float = ORDER_JOURNAL_COMMIT_DELAY):
+        self.path = path
+        self.commit_delay = commit_delay
+        self._file = None
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._committer: Optional[asyncio.Task] = None
+
+    async def append(self, order: Dict[str, Any]) -> str:
+        """Durably append an order; returns its journal_id."""
+        order.setdefault('journal_id', uuid.uuid4().hex)
+        line = (json_util.dumps(order, ensure_ascii=False) + '\n').encode('utf-8')
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((line, future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.create_task(self._commit())
+        await asyncio.shield(future)
+        return order['journal_id']
+
+    async def _commit(self) -> None:
+        while self._pending:
+            if self.commit_delay:
+                # Let orders confirmed at the same moment share one fsync
+                await asyncio.sleep(self.commit_delay)
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write, b''.join(line for line, _ in batch))
+            except Exception as e:
+                logger.error(f"Error writing order journal ({len(batch)} orders): {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'ab')
+            self._truncate_torn_tail()
+        return self._file
+
+    def _truncate_torn_tail(self) -> None:
+        size = self._file.seek(0, os.SEEK_END)
+        if not size:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(max(size - 65536, 0))
+            tail = f.read()
+        if tail.endswith(b'\n'):
+            return
+        keep = size - len(tail) + tail.rfind(b'\n') + 1 if b'\n' in tail else 0
+        logger.warning(f"Order journal ends with a torn record, truncating {size - keep} bytes")
+        self._file.truncate(keep)
+
+    def _write(self, data: bytes) -> None:
+        f = self._open()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _read(self, offset: int, limit: int) -> Tuple[List[Dict[str, Any]], int]:
+        records = []
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return records, offset
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    try:
+                        records.append(json_util.loads(line))
+                    except ValueError as e:
+                        logger.error(f"Skipping unreadable order journal record before offset {offset}: {e}")
+                if len(records) >= limit:
+                    break
+        return records, offset
+
+    async def read(self, offset: int = 0, limit: int = 1000) -> Tuple[List[Dict[str, Any]], int]:
+        """Read up to ``limit`` complete records after byte ``offset``.
+
+        Returns ``(records, next_offset)``; pass ``next_offset`` back to
+        continue a sequential replay.
+        """
+        return await asyncio.to_thread(self._read, offset, limit)
+
+    async def close(self) -> None:
+        """Wait for pending appends and close the file (called on shutdown)."""
+        if self._committer is not None and not self._committer.done():
+            await asyncio.gather(self._committer, return_exceptions=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+order_journal = OrderJournal()
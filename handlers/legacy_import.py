@@ -0,0 +1,376 @@
+import os
+import json
+import hashlib
+import codecs
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Tuple
+
+from pymongo.errors import BulkWriteError
+
+from config import ORDERS_DB, LEGACY_IMPORT_CHECKPOINT, LEGACY_IMPORT_BATCH
+from .mongo import get_orders_collection, connect, sync_indexes, close_client
+from .breaker import maintenance
+
+logger = logging.getLogger(__name__)
+
+# Where legacy exports kept the moment the order was started, in order of preference
+_TIMESTAMP_FIELDS = ('start_time', 'created_at', 'timestamp')
+
+
+def legacy_timestamp(order: Dict[str, Any]) -> Optional[datetime]:
+    """Original creation time of a legacy order (UTC), or None if it has none."""
+    for field in _TIMESTAMP_FIELDS:
+        value = order.get(field)
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                try:
+                    parsed = datetime.fromisoformat(value)
+                except ValueError:
+                    continue
+                return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if value > 1e11:
+                # Milliseconds since the epoch
+                value = value / 1000
+            try:
+                return datetime.fromtimestamp(value, timezone.utc)
+            except (OverflowError, OSError, ValueError):
+                continue
+    return None
+
+
+def legacy_order_key(position: int, user_id: Any, order: Dict[str, Any]) -> str:
+    """Idempotency key of the order at ``position`` of an export.
+
+    The position keeps identical orders of one export apart; the content
+    fingerprint keeps a different export (say, a newer one under the same
+    file name) from being taken for one already imported.
+    """
+    raw = json.dumps([user_id, order], sort_keys=True, ensure_ascii=False, default=str)
+    return f"legacy:{position}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]}"
+
+
+def legacy_order_doc(user_id: Any, order: Dict[str, Any], key: str, imported_at: datetime) -> Dict[str, Any]:
+    """Orders collection document for one legacy order."""
+    if user_id is None:
+        user_id = order.get('user_id')
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        pass
+    created_at = legacy_timestamp(order)
+    doc = {
+        'user_id': user_id,
+        'items': order.get('items', {}),
+        'total': order.get('total', 0),
+        'contact': order.get('contact'),
+        'delivery': order.get('delivery'),
+        'time': order.get('time'),
+        'method': order.get('method'),
+        'summary': order.get('summary'),
+        'created_at': created_at or imported_at,
+        'migrated_at': imported_at,
+        'source': 'orders.json',
+        # Rejected by the unique index if a resumed import inserts it again
+        'idempotency_key': key,
+    }
+    if created_at is None:
+        # No timestamp in the export; keep analytics from trusting this one
+        doc['created_at_estimated'] = True
+    return doc
+
+
+class _OrderStream:
+    """Incremental reader of a legacy orders export.
+
+    Both shapes are understood: ``{"<user_id>": [order, ...], ...}`` and a
+    plain ``[order, ...]`` whose orders carry their own ``user_id``. The file
+    is read in ``chunk_size`` pieces and every order is decoded on its own,
+    so memory use depends on the chunk size, not on the file size.
+    """
+
+    # A single order larger than this means the file is not what we expect
+    MAX_RECORD = 16 * 1024 * 1024
+
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._file = open(path, 'rb')
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._offset = 0
+        self._eof = False
+        self.state = 'start'
+        self.shape: Optional[str] = None
+        self.user_id: Optional[str] = None
+
+    def resume(self, checkpoint: Dict[str, Any]) -> None:
+        """Continue from a position saved with ``position()``."""
+        self._offset = checkpoint['offset']
+        self._file.seek(self._offset)
+        self.state = checkpoint['state']
+        self.shape = checkpoint['shape']
+        self.user_id = checkpoint.get('user_id')
+
+    def position(self) -> Dict[str, Any]:
+        """Where the stream stands, as a JSON-serialisable checkpoint."""
+        return {
+            'offset': self._offset + len(self._buf[:self._pos].encode('utf-8')),
+            'state': self.state,
+            'shape': self.shape,
+            'user_id': self.user_id,
+        }
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _fill(self) -> bool:
+        """Read the next chunk; returns False at the end of the file."""
+        if self._eof:
+            return False
+        data = self._file.read(self.chunk_size)
+        # Drop what was consumed so the buffer stays about one chunk long
+        self._offset += len(self._buf[:self._pos].encode('utf-8'))
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        if not data:
+            self._eof = True
+            self._buf += self._decoder.decode(b'', final=True)
+            return False
+        self._buf += self._decoder.decode(data)
+        return True
+
+    def _peek(self) -> Optional[str]:
+        """Next character that is not whitespace, or None at the end of the file."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n\ufeff':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return None
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at byte {self.position()['offset']} of {self.path}")
+        self._pos += 1
+
+    def _decode(self) -> Any:
+        """Decode the JSON value at the current position."""
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError as e:
+                if self._eof or len(self._buf) - self._pos > self.MAX_RECORD:
+                    raise ValueError(f"Invalid JSON at byte {self.position()['offset']} of {self.path}: {e}")
+                self._fill()
+                continue
+            # A number cut at the chunk boundary still decodes; make sure it ended
+            if end == len(self._buf) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def next_order(self) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        """Next ``(user_id, order)`` pair, or None once the export is read."""
+        while True:
+            if self.state == 'done':
+                return None
+            char = self._peek()
+            if char is None:
+                if self.state != 'start':
+                    raise ValueError(f"{self.path} ends in the middle of the export")
+                self.state = 'done'
+                return None
+            if self.state == 'start':
+                if char not in '{[':
+                    raise ValueError(f"{self.path} is neither an object nor a list of orders")
+                self._pos += 1
+                self.shape = 'dict' if char == '{' else 'list'
+                self.state = 'key' if char == '{' else 'list'
+            elif char == ',':
+                self._pos += 1
+            elif self.state == 'key':
+                if char == '}':
+                    self._pos += 1
+                    self.state = 'done'
+                    continue
+                key = self._decode()
+                self._expect(':')
+                if self._peek() == '[':
+                    self._pos += 1
+                    self.user_id = str(key)
+                    self.state = 'list'
+                else:
+                    self._decode()
+                    logger.warning(f"Skipping legacy entry {key!r}: not a list of orders")
+            elif self.state == 'list':
+                if char == ']':
+                    self._pos += 1
+                    self.state = 'key' if self.shape == 'dict' else 'done'
+                    self.user_id = None
+                    continue
+                order = self._decode()
+                if isinstance(order, dict):
+                    return self.user_id, order
+
+    def read_batch(self, size: int) -> List[Tuple[Optional[str], Dict[str, Any]]]:
+        batch = []
+        while len(batch) < size:
+            item = self.next_order()
+            if item is None:
+                break
+            batch.append(item)
+        return batch
+
+
+class LegacyOrderImporter:
+    """Streams a legacy orders.json export into the orders collection.
+
+    Orders are inserted in unordered ``insert_many`` batches of
+    ``batch_size``, keeping their original ``start_time`` as ``created_at``.
+    After every batch the position in the file is checkpointed, so an
+    interrupted import resumes where it stopped. Every order gets an
+    idempotency key from its position in the export and its content
+    (``legacy_order_key``), and the unique index on that key drops orders a
+    resumed or repeated import inserts twice.
+
+    Parsing and file I/O run in a worker thread, never on the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str = ORDERS_DB,
+        checkpoint_path: str = LEGACY_IMPORT_CHECKPOINT,
+        batch_size: int = LEGACY_IMPORT_BATCH,
+    ):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+
+    def load_checkpoint(self) -> Optional[Dict[str, Any]]:
+        """The saved checkpoint, or None if there is none for this file."""
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return None
+        if (
+            not isinstance(checkpoint, dict)
+            or checkpoint.get('path') != os.path.abspath(self.path)
+            or checkpoint.get('size') != size
+        ):
+            # Checkpoint of another export
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _order_docs(self, batch: List[Tuple[Optional[str], Dict[str, Any]]], read: int) -> List[Dict[str, Any]]:
+        imported_at = datetime.now(timezone.utc)
+        return [
+            legacy_order_doc(user_id, order, legacy_order_key(read + i, user_id, order), imported_at)
+            for i, (user_id, order) in enumerate(batch)
+        ]
+
+    async def _insert_batch(self, docs: List[Dict[str, Any]]) -> int:
+        """Insert one batch; returns how many orders were new."""
+        duplicates = 0
+        try:
+            await get_orders_collection().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != 11000:
+                    raise
+                duplicates += 1
+        return len(docs) - duplicates
+
+    async def run(self, restart: bool = False) -> int:
+        """Import the export (or the rest of it); returns the number of new orders."""
+        checkpoint = None if restart else await asyncio.to_thread(self.load_checkpoint)
+        if checkpoint and checkpoint.get('done'):
+            logger.info(f"Legacy orders from {self.path} already imported")
+            return 0
+
+        size = os.path.getsize(self.path)
+        stream = await asyncio.to_thread(_OrderStream, self.path)
+        read = checkpoint.get('read', 0) if checkpoint else 0
+        imported = checkpoint.get('imported', 0) if checkpoint else 0
+        new = 0
+        if checkpoint:
+            stream.resume(checkpoint['position'])
+            logger.info(f"Resuming legacy import of {self.path} after {read} orders")
+        try:
+            while True:
+                batch = await asyncio.to_thread(stream.read_batch, self.batch_size)
+                if not batch:
+                    break
+                docs = await asyncio.to_thread(self._order_docs, batch, read)
+                with maintenance():
+                    inserted = await self._insert_batch(docs)
+                read += len(batch)
+                imported += inserted
+                new += inserted
+                checkpoint = {
+                    'path': os.path.abspath(self.path),
+                    'size': size,
+                    'position': stream.position(),
+                    'read': read,
+                    'imported': imported,
+                    'done': False,
+                }
+                await asyncio.to_thread(self._save_checkpoint, checkpoint)
+                done_share = checkpoint['position']['offset'] / size if size else 1
+                logger.info(f"Legacy import: {read} orders read, {imported} imported ({done_share:.0%} of {self.path})")
+        finally:
+            stream.close()
+
+        await asyncio.to_thread(self._save_checkpoint, {
+            'path': os.path.abspath(self.path),
+            'size': size,
+            'position': stream.position(),
+            'read': read,
+            'imported': imported,
+            'done': True,
+        })
+        logger.info(f"Legacy import of {self.path} finished: {read} orders read, {imported} imported")
+        return new
+
+
+async def _main(args: argparse.Namespace) -> None:
+    await connect()
+    try:
+        # The unique idempotency_key index is what makes resuming safe
+        await sync_indexes()
+        importer = LegacyOrderImporter(args.path, args.checkpoint, args.batch_size)
+        new = await importer.run(restart=args.restart)
+        print(f"✅ {new} legacy orders imported from {args.path}")
+    finally:
+        close_client()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import a legacy orders.json export into the orders collection.')
+    parser.add_argument('path', nargs='?', default=ORDERS_DB, help='legacy export (default: %(default)s)')
+    parser.add_argument('--checkpoint', default=LEGACY_IMPORT_CHECKPOINT, help='checkpoint file (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=LEGACY_IMPORT_BATCH, help='orders per insert (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and read the export from the start')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    asyncio.run(_main(parser.parse_args()))
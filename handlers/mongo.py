@@ -2,26 +2,41 @@ from __future__ import annotations
 
 import os
 import json
+import time
+import hashlib
+import asyncio
 import logging
 from typing import Any, Dict, List, Optional
 from datetime import datetime, timezone
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
 
 from config import (
     MONGO_URI,
     MONGO_DB_NAME,
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    MONGO_MIN_POOL_SIZE,
+    MONGO_PROBE_TIMEOUT,
     MONGO_COLLECTION_ORDERS,
     MONGO_COLLECTION_REVIEWS,
     MONGO_COLLECTION_AVAILABILITY,
     MONGO_COLLECTION_PRODUCTS,
     MONGO_COLLECTION_NOTIFICATIONS,
+    MONGO_COLLECTION_NOTIFICATIONS_DEAD,
     MONGO_COLLECTION_TEMP_CARTS,
+    MONGO_COLLECTION_OUTBOX,
+    MONGO_COLLECTION_USER_STATS,
+    MONGO_COLLECTION_META,
+    OUTBOX_RETENTION_DAYS,
     DATA_DIR,
     ORDERS_DB,
     REVIEWS_FILE,
     AVAILABILITY_FILE,
+    AVAILABILITY_CACHE_TTL,
 )
+from .breaker import GuardedDatabase, mongo_breaker
 from .catalog import PRICES, DISPLAY_NAMES, SHORT_NAMES, SAMSA_KEYS, ALL_KEYS
 
 _client: Optional[AsyncIOMotorClient] = None
@@ -30,6 +45,10 @@ _client: Optional[AsyncIOMotorClient] = None
 def close_client():
     """Close MongoDB client connection."""
     global _client
+    # Background index sync / legacy import resume on the next start
+    for task in (_index_task, _orders_import_task):
+        if task is not None and not task.done():
+            task.cancel()
     if _client:
         try:
             _client.close()
@@ -38,79 +57,128 @@ def close_client():
         _client = None
 
 
+# Candidate client configurations, probed concurrently by connect()
+CONNECTION_PROFILES = [
+    # Minimal connection (most compatible)
+    ('minimal', {
+        "serverSelectionTimeoutMS": 5000,
+        "connectTimeoutMS": 5000,
+        "socketTimeoutMS": 5000,
+    }),
+    # Standard Atlas connection
+    ('standard', {
+        "serverSelectionTimeoutMS": 10000,
+        "connectTimeoutMS": 10000,
+        "socketTimeoutMS": 10000,
+        "maxPoolSize": 10,
+        "retryWrites": True,
+        "retryReads": True,
+    }),
+    # Patient settings for slow networks
+    ('patient', {
+        "serverSelectionTimeoutMS": 15000,
+        "connectTimeoutMS": 15000,
+        "socketTimeoutMS": 15000,
+        "maxPoolSize": 5,
+        "retryWrites": True,
+        "retryReads": True,
+    }),
+]
+
+
+def _profile_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    min_pool = min(MONGO_MIN_POOL_SIZE, options.get('maxPoolSize', MONGO_MIN_POOL_SIZE))
+    return {**options, 'minPoolSize': min_pool}
+
+
+async def _probe(name: str, options: Dict[str, Any]):
+    """Ping with one profile; returns (rtt_seconds, client), raising on failure."""
+    client = AsyncIOMotorClient(MONGO_URI, **_profile_options(options))
+    try:
+        # The first ping pays server selection and the TLS handshake;
+        # the second one measures the round trip on the open connection
+        await asyncio.wait_for(client.admin.command('ping'), MONGO_PROBE_TIMEOUT)
+        started = time.perf_counter()
+        await asyncio.wait_for(client.admin.command('ping'), MONGO_PROBE_TIMEOUT)
+        return time.perf_counter() - started, client
+    except BaseException:
+        client.close()
+        raise
+
+
+async def _warm_pool(client: AsyncIOMotorClient, size: int) -> None:
+    """Open ``size`` pooled connections now instead of on the first requests."""
+    if size > 1:
+        await asyncio.gather(*(client.admin.command('ping') for _ in range(size)), return_exceptions=True)
+
+
+async def connect() -> AsyncIOMotorClient:
+    """Pick the fastest healthy connection profile and warm its pool.
+
+    Every profile in CONNECTION_PROFILES is probed concurrently with a real
+    ping; the one with the lowest measured round trip becomes the client and
+    the others are closed. Local storage backends need no probing.
+    """
+    global _client
+    if STORAGE_BACKEND != 'mongo':
+        client = _get_client()
+        # Stored collections are read on the storage thread, not on first use
+        await client[MONGO_DB_NAME].preload()
+        return client
+    if _client is not None:
+        return _get_client()
+    if not MONGO_URI:
+        raise RuntimeError("MONGO_URI is not configured in environment")
+
+    results = await asyncio.gather(
+        *(_probe(name, options) for name, options in CONNECTION_PROFILES),
+        return_exceptions=True,
+    )
+    healthy = []
+    last_error = None
+    for (name, options), result in zip(CONNECTION_PROFILES, results):
+        if isinstance(result, BaseException):
+            last_error = result
+            print(f"❌ MongoDB profile '{name}' failed: {result}")
+        else:
+            healthy.append((result[0], name, options, result[1]))
+    if not healthy:
+        print("⚠️ All MongoDB connection profiles failed, will use fallback mode")
+        raise RuntimeError(f"All MongoDB connection profiles failed: {last_error}")
+
+    healthy.sort(key=lambda h: h[0])
+    rtt, name, options, client = healthy[0]
+    for _, _, _, other in healthy[1:]:
+        other.close()
+    if _client is not None:
+        # Someone created a client while we were probing; keep theirs
+        client.close()
+        return _client
+    _client = client
+    min_pool = _profile_options(options)['minPoolSize']
+    await _warm_pool(_client, min_pool)
+    print(f"✅ MongoDB profile '{name}' selected: RTT {rtt * 1000:.1f} ms, {min_pool} pooled connections warmed")
+    return _client
+
+
 def _get_client() -> AsyncIOMotorClient:
+    """The shared client; connect() normally creates it at startup."""
     global _client
+    if _client is None and STORAGE_BACKEND != 'mongo':
+        # Local backend with the same collection API (see handlers/storage.py)
+        from .storage import open_local_client
+        _client = open_local_client(STORAGE_BACKEND, SQLITE_PATH)
     if _client is None:
         if not MONGO_URI:
             raise RuntimeError("MONGO_URI is not configured in environment")
-        
-        # Try multiple connection strategies for MongoDB Atlas
-        connection_strategies = [
-            # Strategy 1: Minimal connection (most compatible)
-            {
-                "serverSelectionTimeoutMS": 5000,
-                "connectTimeoutMS": 5000,
-                "socketTimeoutMS": 5000,
-            },
-            # Strategy 2: Standard Atlas connection
-            {
-                "serverSelectionTimeoutMS": 10000,
-                "connectTimeoutMS": 10000,
-                "socketTimeoutMS": 10000,
-                "maxPoolSize": 10,
-                "minPoolSize": 1,
-                "retryWrites": True,
-                "retryReads": True,
-            },
-            # Strategy 3: Atlas with custom SSL context
-            {
-                "serverSelectionTimeoutMS": 15000,
-                "connectTimeoutMS": 15000,
-                "socketTimeoutMS": 15000,
-                "maxPoolSize": 5,
-                "minPoolSize": 1,
-                "retryWrites": True,
-                "retryReads": True,
-            }
-        ]
-        
-        last_error = None
-        for i, strategy in enumerate(connection_strategies):
-            try:
-                print(f"🧪 Trying MongoDB connection strategy {i+1}...")
-                _client = AsyncIOMotorClient(MONGO_URI, **strategy)
-                
-                # Test the connection without creating new event loops
-                import asyncio
-                try:
-                    # Simple connection test - don't create new loops
-                    # Just create the client and let it connect naturally
-                    print(f"✅ MongoDB client created with strategy {i+1}")
-                    break
-                except Exception as e:
-                    last_error = e
-                    print(f"❌ Strategy {i+1} failed: {e}")
-                    if _client:
-                        try:
-                            _client.close()
-                        except:
-                            pass
-                        _client = None
-                    
-            except Exception as e:
-                last_error = e
-                print(f"❌ Strategy {i+1} failed: {e}")
-                continue
-        
-        if _client is None:
-            print("⚠️ All MongoDB connection strategies failed, will use fallback mode")
-            raise RuntimeError(f"All MongoDB connection strategies failed: {last_error}")
-            
+        # Not probed (connect() was skipped or failed): use the first profile
+        _client = AsyncIOMotorClient(MONGO_URI, **_profile_options(CONNECTION_PROFILES[0][1]))
     return _client
 
 
 def get_db():
-    return _get_client()[MONGO_DB_NAME]
+    # Every collection call goes through the circuit breaker
+    return GuardedDatabase(_get_client()[MONGO_DB_NAME], mongo_breaker)
 
 
 def get_orders_collection() -> AsyncIOMotorCollection:
@@ -131,44 +199,169 @@ def get_notifications_collection() -> AsyncIOMotorCollection:
     return get_db()[MONGO_COLLECTION_NOTIFICATIONS]
 
 
+def get_dead_notifications_collection() -> AsyncIOMotorCollection:
+    """Notifications that can never be delivered, with dead_reason."""
+    return get_db()[MONGO_COLLECTION_NOTIFICATIONS_DEAD]
+
+
 def get_temp_carts_collection() -> AsyncIOMotorCollection:
     """Get temporary carts collection."""
     return get_db()[MONGO_COLLECTION_TEMP_CARTS]
 
 
-async def test_connection() -> bool:
-    """Test MongoDB connection and return True if successful"""
-    try:
-        client = _get_client()
-        # Test the connection by running a simple command
-        await client.admin.command('ping')
-        print("MongoDB connection successful")
-        return True
-    except Exception as e:
-        print(f"MongoDB connection failed: {e}")
-        return False
+def get_outbox_collection() -> AsyncIOMotorCollection:
+    """Order events written together with the order, relayed to subscribers."""
+    return get_db()[MONGO_COLLECTION_OUTBOX]
 
 
-async def ensure_indexes() -> None:
-    try:
-        # Test connection first
-        if not await test_connection():
-            print("Cannot create indexes - MongoDB connection failed")
-            return
-            
-        orders = get_orders_collection()
-        await orders.create_index("user_id")
-        await orders.create_index("created_at")
-        products = get_products_collection()
-        await products.create_index("key", unique=True)
-        notifications = get_notifications_collection()
-        await notifications.create_index("user_id")
-        await notifications.create_index("sent")
-        await notifications.create_index("created_at")
-        print("MongoDB indexes created successfully")
-    except Exception as e:
-        print(f"Error creating indexes: {e}")
-        raise
+def get_user_stats_collection() -> AsyncIOMotorCollection:
+    """Per-customer order counters, keyed by user_id."""
+    return get_db()[MONGO_COLLECTION_USER_STATS]
+
+
+def get_meta_collection() -> AsyncIOMotorCollection:
+    """Bookkeeping documents of the bot itself (e.g. the seeded catalog hash)."""
+    return get_db()[MONGO_COLLECTION_META]
+
+
+_supports_transactions: Optional[bool] = None
+
+
+async def supports_transactions() -> bool:
+    """True when connected to a replica set or sharded cluster (cached)."""
+    global _supports_transactions
+    if _supports_transactions is None:
+        try:
+            # Through the circuit breaker like every other call
+            hello = await get_db().command('hello')
+            _supports_transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        except Exception as e:
+            logging.error(f"Error detecting MongoDB topology: {e}")
+            return False
+    return _supports_transactions
+
+
+def start_session():
+    """Start a client session (use with ``async with await start_session()``)."""
+    return _get_client().start_session()
+
+
+def declared_indexes() -> Dict[str, List[IndexModel]]:
+    """The index set this bot relies on, per collection name.
+
+    Default index names are kept so deployments created by the old
+    create_index calls are recognised as up to date.
+    """
+    return {
+        MONGO_COLLECTION_ORDERS: [
+            IndexModel([('created_at', ASCENDING)]),
+            # Admin bot: new orders, newest/oldest first
+            IndexModel([('status', ASCENDING), ('created_at', ASCENDING)]),
+            # Order history of one customer, newest first
+            IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING)]),
+            # Offline orders replayed from the local journal
+            IndexModel([('journal_id', ASCENDING)], unique=True, sparse=True),
+            # One order per checkout (double taps on Confirm)
+            IndexModel(
+                [('idempotency_key', ASCENDING)],
+                unique=True,
+                partialFilterExpression={'idempotency_key': {'$type': 'string'}},
+            ),
+        ],
+        MONGO_COLLECTION_PRODUCTS: [
+            IndexModel([('key', ASCENDING)], unique=True),
+        ],
+        MONGO_COLLECTION_NOTIFICATIONS: [
+            IndexModel([('user_id', ASCENDING)]),
+            # Checker hot query: unsent notifications, oldest first
+            IndexModel(
+                [('sent', ASCENDING), ('created_at', ASCENDING)],
+                partialFilterExpression={'sent': False},
+                name='unsent_created_at',
+            ),
+            # Due items of the retry schedule
+            IndexModel([('next_attempt_at', ASCENDING), ('created_at', ASCENDING)], partialFilterExpression={'sent': False}),
+            # Read-back of a claimed batch
+            IndexModel([('claim_token', ASCENDING)], sparse=True),
+            # Newest status already sent for an order (stale retries are dropped)
+            IndexModel([('order_id', ASCENDING), ('created_at', DESCENDING)]),
+        ],
+        MONGO_COLLECTION_TEMP_CARTS: [
+            IndexModel([('user_id', ASCENDING)], unique=True),
+            # Auto-delete abandoned carts after 7 days
+            IndexModel([('created_at', ASCENDING)], expireAfterSeconds=7*24*60*60),
+        ],
+        MONGO_COLLECTION_OUTBOX: [
+            # Consumers deduplicate on this key
+            IndexModel([('idempotency_key', ASCENDING)], unique=True),
+            # Relay hot query: undelivered events that are due
+            IndexModel(
+                [('delivered', ASCENDING), ('next_attempt_at', ASCENDING), ('created_at', ASCENDING)],
+                partialFilterExpression={'delivered': False},
+                name='undelivered_due',
+            ),
+            IndexModel([('claim_token', ASCENDING)], sparse=True),
+            # Only delivered events expire; undelivered ones wait for the relay
+            IndexModel([('delivered_at', ASCENDING)], expireAfterSeconds=OUTBOX_RETENTION_DAYS*24*60*60),
+        ],
+    }
+
+
+# Indexes the bot used to declare and must not keep, per collection name
+RETIRED_INDEXES: Dict[str, List[str]] = {
+    # TTL on created_at deleted events that were never delivered
+    MONGO_COLLECTION_OUTBOX: ['created_at_1'],
+}
+
+
+_INDEX_OPTIONS = ('unique', 'sparse', 'partialFilterExpression', 'expireAfterSeconds')
+
+
+def _index_options(spec: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: spec[k] for k in _INDEX_OPTIONS if k in spec and spec[k] not in (None, False)}
+
+
+async def sync_indexes() -> None:
+    """Create every declared index that is missing.
+
+    Existing indexes are matched by name; one whose keys or options differ
+    from the declaration is reported but never dropped automatically. Only
+    indexes listed in RETIRED_INDEXES are dropped.
+    """
+    db = get_db()
+    for collection_name, models in declared_indexes().items():
+        col = db[collection_name]
+        existing = await col.index_information()
+        for name in RETIRED_INDEXES.get(collection_name, []):
+            if name in existing:
+                await col.drop_index(name)
+                logging.info(f"Dropped retired index {name} on {collection_name}")
+        missing = []
+        for model in models:
+            spec = model.document
+            current = existing.get(spec['name'])
+            if current is None:
+                missing.append(model)
+                continue
+            declared_key = [(field, direction) for field, direction in spec['key'].items()]
+            current_key = [(field, direction) for field, direction in current['key']]
+            if current_key != declared_key or _index_options(current) != _index_options(spec):
+                logging.warning(
+                    f"Index {spec['name']} on {collection_name} differs from the declared one; "
+                    f"drop it to let the bot recreate it"
+                )
+        if missing:
+            names = await col.create_indexes(missing)
+            logging.info(f"Created indexes on {collection_name}: {', '.join(names)}")
+
+
+_index_task: Optional[asyncio.Task] = None
+_orders_import_task: Optional[asyncio.Task] = None
+
+
+def _log_index_task(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background index sync failed: {task.exception()}")
 
 
 async def seed_reviews_if_needed() -> None:
@@ -217,28 +410,53 @@ async def seed_availability_if_needed() -> None:
         return
 
 
-async def seed_inventory_from_catalog() -> None:
+def catalog_hash() -> str:
+    """Fingerprint of the catalog data the products collection is built from."""
+    catalog = {
+        'keys': ALL_KEYS,
+        'samsa_keys': SAMSA_KEYS,
+        'prices': PRICES,
+        'display_names': DISPLAY_NAMES,
+        'short_names': SHORT_NAMES,
+    }
+    raw = json.dumps(catalog, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+async def seed_inventory_from_catalog() -> bool:
+    """Sync the products collection and availability map with the catalog.
+
+    Skipped when the catalog hash stored in the meta collection matches the
+    current one and the availability map already lists every product.
+    Returns whether anything was written.
+    """
     avail_col = get_availability_collection()
     prod_col = get_products_collection()
-    # Ensure a baseline availability doc exists
-    doc = await avail_col.find_one({'_id': 'availability'})
-    if not doc or not isinstance(doc, dict):
-        await avail_col.replace_one(
-            {'_id': 'availability'},
-            {'_id': 'availability', 'items': {}, 'migrated_at': datetime.now(timezone.utc)},
-            upsert=True,
-        )
-        doc = {'_id': 'availability', 'items': {}}
+    meta_col = get_meta_collection()
+    current_hash = catalog_hash()
+    doc, meta = await asyncio.gather(
+        avail_col.find_one({'_id': 'availability'}),
+        meta_col.find_one({'_id': 'catalog'}),
+    )
     items_map = doc.get('items', {}) if isinstance(doc, dict) else {}
-    if isinstance(items_map, bool):
+    if not isinstance(items_map, dict):
         # Fix bad type if previously written incorrectly
         items_map = {}
+    if (
+        isinstance(doc, dict)
+        and meta
+        and meta.get('hash') == current_hash
+        and all(key in items_map for key in ALL_KEYS)
+    ):
+        return False
     # Sync products collection (one doc per product) - include all items
+    now = datetime.now(timezone.utc)
+    ops = []
     for key in ALL_KEYS:
         display_name = DISPLAY_NAMES.get(key, key)
         price = PRICES.get(key, 0)
         short_name = SHORT_NAMES.get(key, key)
-        await prod_col.update_one(
+        ops.append(UpdateOne(
             {'key': key},
             {'$set': {
                 'key': key,
@@ -246,100 +464,112 @@ async def seed_inventory_from_catalog() -> None:
                 'short_name': short_name,
                 'price': price,
                 'category': 'samsa' if key in SAMSA_KEYS else 'packaging',
-                'updated_at': datetime.now(timezone.utc),
+                'updated_at': now,
             }, '$setOnInsert': {
-                'created_at': datetime.now(timezone.utc)
+                'created_at': now
             }},
             upsert=True
-        )
+        ))
         if key not in items_map:
             items_map[key] = True
-    # Write back availability map
-    await avail_col.update_one({'_id': 'availability'}, {
-        '$set': {
-            'items': items_map,
-            'synced_at': datetime.now(timezone.utc)
-        }
-    })
+    # Write back availability map (creates the baseline doc if missing)
+    await asyncio.gather(
+        prod_col.bulk_write(ops, ordered=False),
+        avail_col.update_one({'_id': 'availability'}, {
+            '$set': {
+                'items': items_map,
+                'synced_at': now
+            },
+            '$setOnInsert': {'migrated_at': now},
+        }, upsert=True),
+    )
+    # Only recorded once both writes succeeded, so a failed sync is retried
+    await meta_col.update_one(
+        {'_id': 'catalog'},
+        {'$set': {'hash': current_hash, 'synced_at': now}},
+        upsert=True,
+    )
+    return True
 
 
 async def seed_orders_if_needed() -> None:
-    col = get_orders_collection()
-    count = await col.estimated_document_count()
-    if count > 0:
-        return
     path = ORDERS_DB
     if not os.path.exists(path):
         return
+    from .legacy_import import LegacyOrderImporter
+    importer = LegacyOrderImporter(path)
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            orders_by_user = json.load(f)
-        if not isinstance(orders_by_user, dict):
+        checkpoint = await asyncio.to_thread(importer.load_checkpoint)
+        # Without a checkpoint, orders in the collection mean the export was
+        # migrated already (or never needed); a checkpoint means resume
+        if checkpoint is None and await get_orders_collection().estimated_document_count() > 0:
             return
-        docs: List[Dict[str, Any]] = []
-        for user_id_str, orders in orders_by_user.items():
-            if not isinstance(orders, list):
-                continue
-            for order in orders:
-                if not isinstance(order, dict):
-                    continue
-                try:
-                    user_id: Any = int(user_id_str)
-                except Exception:
-                    user_id = user_id_str
-                docs.append({
-                    'user_id': user_id,
-                    'items': order.get('items', {}),
-                    'total': order.get('total', 0),
-                    'contact': order.get('contact'),
-                    'delivery': order.get('delivery'),
-                    'time': order.get('time'),
-                    'method': order.get('method'),
-                    'summary': order.get('summary'),
-                    'created_at': datetime.now(timezone.utc),
-                    'migrated_at': datetime.now(timezone.utc),
-                    'source': 'orders.json',
-                })
-        if docs:
-            # Insert in chunks to avoid large batch
-            chunk_size = 1000
-            for i in range(0, len(docs), chunk_size):
-                await col.insert_many(docs[i:i+chunk_size])
+        await importer.run()
+    except Exception as e:
+        # Best-effort seed; the next start resumes from the checkpoint
+        logging.error(f"Error importing legacy orders from {path}: {e}")
+
+
+async def _seed_availability_and_inventory() -> None:
+    # The catalog sync extends the availability doc the file seed creates
+    await seed_availability_if_needed()
+    if await seed_inventory_from_catalog():
+        print("Products synced with the catalog")
+
+
+async def _import_orders_after_indexes(index_task: asyncio.Task) -> None:
+    # A resumed import relies on the unique idempotency_key index
+    try:
+        await index_task
     except Exception:
+        logging.error("Legacy orders import skipped: index sync failed")
         return
+    await seed_orders_if_needed()
 
 
-async def initialize_temp_carts() -> None:
-    """Initialize temp_carts collection with indexes"""
-    try:
-        temp_carts_col = get_temp_carts_collection()
-        # Create index on user_id for fast lookups
-        await temp_carts_col.create_index("user_id", unique=True)
-        # Create TTL index to auto-delete old carts after 7 days
-        await temp_carts_col.create_index("created_at", expireAfterSeconds=7*24*60*60)
-        logging.info("✅ Temp carts collection initialized")
-    except Exception as e:
-        logging.error(f"❌ Error initializing temp_carts: {e}")
+async def prepare_database() -> None:
+    """Sync indexes and seed whatever is missing; safe to repeat.
+
+    Runs at startup and again whenever MongoDB comes back from an outage
+    (the database may have been replaced, or never set up if the bot
+    started offline). Index builds and the legacy orders import run in the
+    background; use ``indexes_ready`` before relying on the unique indexes.
+    """
+    global _index_task, _orders_import_task
+    # Index builds can take a while on big collections; don't hold up startup
+    if _index_task is None or _index_task.done():
+        _index_task = asyncio.create_task(sync_indexes())
+        _index_task.add_done_callback(_log_index_task)
+    # A large legacy export must not hold up the first update either
+    if _orders_import_task is None or _orders_import_task.done():
+        _orders_import_task = asyncio.create_task(_import_orders_after_indexes(_index_task))
+    await asyncio.gather(
+        _seed_availability_and_inventory(),
+        seed_reviews_if_needed(),
+    )
+
+
+async def indexes_ready() -> None:
+    """Wait for the background index sync; a failed one is started again."""
+    global _index_task
+    if _index_task is None or _index_task.cancelled() or (_index_task.done() and _index_task.exception()):
+        _index_task = asyncio.create_task(sync_indexes())
+        _index_task.add_done_callback(_log_index_task)
+    await asyncio.shield(_index_task)
 
 
 async def initialize_database() -> None:
-    await ensure_indexes()
-    await seed_availability_if_needed()
-    await seed_inventory_from_catalog()
-    await seed_reviews_if_needed()
-    await seed_orders_if_needed()
-    await initialize_temp_carts()
+    # Probes the connection profiles with a real ping (raises if none is healthy)
+    await connect()
+    await prepare_database()
 
 
-async def get_availability_dict() -> Dict[str, bool]:
+def parse_availability_doc(doc: Optional[Dict[str, Any]]) -> Dict[str, bool]:
     """
-    Get availability status for all items.
+    Extract the availability map from the availability document.
     Reads from root-level fields (preferred) or items subdocument (fallback).
-    Returns dict with item keys and their availability (True/False).
-    Default is True if item is not in the availability document.
+    Returns an empty dict when the document carries no availability data.
     """
-    doc = await get_availability_collection().find_one({'_id': 'availability'})
-    
     if doc and isinstance(doc, dict):
         # Extract root-level boolean fields (excluding metadata)
         excluded_keys = {'_id', 'items', 'migrated_at', 'synced_at'}
@@ -358,20 +588,137 @@ async def get_availability_dict() -> Dict[str, bool]:
         if isinstance(doc.get('items'), dict):
             return {k: bool(v) for k, v in doc['items'].items()}
     
-    # Fallback to file if MongoDB fails
-    path = AVAILABILITY_FILE
-    if os.path.exists(path):
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                avail = json.load(f)
-            if isinstance(avail, dict):
-                return {k: bool(v) for k, v in avail.items()}
-        except Exception:
-            pass
-    
     return {}
 
 
+class AvailabilitySnapshot(dict):
+    """Availability map tagged with the cache version that produced it.
+
+    Snapshots are shared between handlers and must not be mutated; a change
+    always produces a new snapshot with a higher version.
+    """
+
+    def __init__(self, items: Dict[str, bool], version: int, source: str):
+        super().__init__(items)
+        self.version = version
+        self.source = source
+        self.loaded_at = time.monotonic()
+
+
+class AvailabilityCache:
+    """In-process cache of the availability document.
+
+    Concurrent misses share a single MongoDB read (single-flight), results are
+    reused for ``ttl`` seconds, and every distinct availability map gets a new,
+    monotonically increasing version. The AVAILABILITY_FILE fallback is only
+    re-parsed when its mtime changes.
+    """
+
+    def __init__(self, ttl: float = AVAILABILITY_CACHE_TTL):
+        self.ttl = ttl
+        self._snapshot: Optional[AvailabilitySnapshot] = None
+        self._version = 0
+        self._inflight: Optional[asyncio.Future] = None
+        self._file_mtime: Optional[float] = None
+        self._file_items: Dict[str, bool] = {}
+        self._bot_data: Optional[Dict[str, Any]] = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bind(self, bot_data: Dict[str, Any]) -> None:
+        """Keep bot_data['avail'] pointing at the current snapshot."""
+        self._bot_data = bot_data
+        if self._snapshot is not None:
+            bot_data['avail'] = self._snapshot
+
+    def peek(self) -> Optional[AvailabilitySnapshot]:
+        """Return the current snapshot without any I/O (may be stale)."""
+        return self._snapshot
+
+    def _is_fresh(self) -> bool:
+        snapshot = self._snapshot
+        return snapshot is not None and time.monotonic() - snapshot.loaded_at < self.ttl
+
+    def publish(self, items: Dict[str, bool], source: str = 'mongo') -> AvailabilitySnapshot:
+        """Install a new availability map, bumping the version if it changed."""
+        current = self._snapshot
+        if current is not None and dict(current) == items:
+            current.loaded_at = time.monotonic()
+            return current
+        self._version += 1
+        snapshot = AvailabilitySnapshot(items, self._version, source)
+        self._snapshot = snapshot
+        if self._bot_data is not None:
+            self._bot_data['avail'] = snapshot
+        logging.debug(f"Availability snapshot v{snapshot.version} from {source}: {len(snapshot)} items")
+        return snapshot
+
+    def _load_file(self) -> Dict[str, bool]:
+        path = AVAILABILITY_FILE
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        if mtime != self._file_mtime:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    avail = json.load(f)
+                self._file_items = {k: bool(v) for k, v in avail.items()} if isinstance(avail, dict) else {}
+            except Exception:
+                self._file_items = {}
+            self._file_mtime = mtime
+        return self._file_items
+
+    async def _load(self) -> AvailabilitySnapshot:
+        try:
+            doc = await get_availability_collection().find_one({'_id': 'availability'})
+        except Exception as e:
+            if self._snapshot is None:
+                raise
+            logging.error(f"Availability reload failed, serving v{self._snapshot.version}: {e}")
+            return self._snapshot
+        availability = parse_availability_doc(doc)
+        if availability:
+            return self.publish(availability, 'mongo')
+        # Fallback to file if MongoDB has no availability data
+        file_items = self._load_file()
+        if not file_items and self._snapshot is not None:
+            return self._snapshot
+        return self.publish(dict(file_items), 'file')
+
+    async def refresh(self) -> AvailabilitySnapshot:
+        """Reload from MongoDB, joining a load that is already in flight."""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._load())
+            self._inflight.add_done_callback(self._clear_inflight)
+        # shield: a cancelled caller must not cancel the shared load
+        return await asyncio.shield(self._inflight)
+
+    def _clear_inflight(self, _future: asyncio.Future) -> None:
+        self._inflight = None
+
+    async def get(self) -> AvailabilitySnapshot:
+        if self._is_fresh():
+            return self._snapshot
+        return await self.refresh()
+
+
+availability_cache = AvailabilityCache()
+
+
+async def get_availability_dict() -> Dict[str, bool]:
+    """
+    Get availability status for all items.
+    Reads from root-level fields (preferred) or items subdocument (fallback).
+    Returns dict with item keys and their availability (True/False).
+    Default is True if item is not in the availability document.
+    Served from availability_cache; returns the shared snapshot object.
+    """
+    return await availability_cache.get()
+
+
 async def is_item_available(key: str) -> bool:
     """
     Check if a specific item is available for ordering.
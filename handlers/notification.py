@@ -1,189 +1,914 @@
+import os
+import time
+import uuid
+import random
+import socket
 import asyncio
 import logging
-from datetime import datetime, timezone
-from typing import Optional, Dict, Any
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, Callable, Awaitable, List
 
+from bson import json_util
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest
 
-from .mongo import get_notifications_collection, get_orders_collection, get_availability_dict
+from config import (
+    NOTIFICATION_GLOBAL_RATE,
+    NOTIFICATION_PER_CHAT_RATE,
+    NOTIFICATION_WORKERS,
+    NOTIFICATION_MAX_FLOOD_RETRIES,
+    NOTIFICATION_ACK_LOG,
+    NOTIFICATION_ACK_BATCH_SIZE,
+    NOTIFICATION_ACK_FLUSH_INTERVAL,
+    NOTIFICATION_LEASE_SECONDS,
+    NOTIFICATION_CLAIM_BATCH,
+    NOTIFICATION_RETRY_BASE,
+    NOTIFICATION_RETRY_MAX,
+    NOTIFICATION_MAX_ATTEMPTS,
+    NOTIFICATION_MIN_INTERVAL,
+    NOTIFICATION_MAX_INTERVAL,
+    NOTIFICATION_POLL_JITTER,
+    NOTIFICATION_MAX_PER_TICK,
+    NOTIFICATION_FRESH_SHARE,
+)
+from .mongo import get_notifications_collection, get_orders_collection, get_dead_notifications_collection
 
 logger = logging.getLogger(__name__)
 
+# Identifies this process in notification claims (claimed_by)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
-async def edit_order_status_message(bot: Bot, user_id: int, order_id: str, new_message: str) -> bool:
-    """Try to edit existing order status message instead of sending new one."""
+# Admin-side notifications are handled by the admin bot
+ADMIN_NOTIFICATION_STATUSES = ['preorder', 'card_payment_verification']
+
+
+# Fields the delivery path needs; everything else stays on the server
+NOTIFICATION_PROJECTION = {
+    'user_id': 1,
+    'order_id': 1,
+    'status': 1,
+    'message': 1,
+    'original_message': 1,
+    'edit_message': 1,
+    'message_id': 1,
+    'attempts': 1,
+    'created_at': 1,
+}
+
+# BadRequest messages that will never succeed on retry
+_PERMANENT_BAD_REQUESTS = ('chat not found', 'user not found', 'peer_id_invalid', 'chat_id is empty')
+
+
+def _claimable_filter(now: datetime) -> Dict[str, Any]:
+    """Unsent client notifications that are due and nobody holds a live lease on.
+
+    ``None`` also matches a missing field, so documents written without
+    retry or lease fields are due immediately.
+    """
+    return {
+        'sent': False,
+        'status': {'$nin': ADMIN_NOTIFICATION_STATUSES},
+        '$and': [
+            {'$or': [{'next_attempt_at': None}, {'next_attempt_at': {'$lte': now}}]},
+            {'$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+        ],
+    }
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff in seconds after ``attempts`` failed deliveries."""
+    return min(NOTIFICATION_RETRY_BASE * (2 ** max(attempts - 1, 0)), NOTIFICATION_RETRY_MAX)
+
+
+def permanent_failure_reason(error: TelegramError) -> Optional[str]:
+    """Return a dead-letter reason if ``error`` can never be fixed by retrying."""
+    if isinstance(error, Forbidden):
+        # e.g. "Forbidden: bot was blocked by the user", "user is deactivated"
+        return f"forbidden: {error.message}"
+    if isinstance(error, BadRequest) and any(m in error.message.lower() for m in _PERMANENT_BAD_REQUESTS):
+        return f"bad_request: {error.message}"
+    return None
+
+
+async def claim_notifications(
+    limit: int = NOTIFICATION_CLAIM_BATCH,
+    worker_id: str = WORKER_ID,
+    lease_seconds: float = NOTIFICATION_LEASE_SECONDS,
+    fresh_share: float = NOTIFICATION_FRESH_SHARE,
+) -> List[Dict[str, Any]]:
+    """Claim up to ``limit`` notifications in three round trips.
+
+    Candidates are read first, then claimed with one update_many that
+    re-checks the claimable filter per document (so two replicas can never
+    both win the same notification), and finally the documents carrying this
+    call's claim token are read back. Expired leases are claimable again.
+
+    Most candidates are the oldest due items, but ``fresh_share`` of the
+    batch is reserved for the newest ones so a large backlog cannot starve
+    fresh status updates.
+    """
+    col = get_notifications_collection()
+    now = datetime.now(timezone.utc)
+    fresh_limit = int(limit * fresh_share)
+    oldest_cursor = col.find(_claimable_filter(now), {'_id': 1}).sort('created_at', 1).limit(limit - fresh_limit)
+    queries = [oldest_cursor.to_list(length=None)]
+    if fresh_limit:
+        newest_cursor = col.find(_claimable_filter(now), {'_id': 1}).sort('created_at', -1).limit(fresh_limit)
+        queries.append(newest_cursor.to_list(length=None))
+    ids = list(dict.fromkeys(doc['_id'] for docs in await asyncio.gather(*queries) for doc in docs))
+    if not ids:
+        return []
+    claim_token = uuid.uuid4().hex
+    claim_filter = _claimable_filter(now)
+    claim_filter['_id'] = {'$in': ids}
+    result = await col.update_many(
+        claim_filter,
+        {'$set': {
+            'claimed_by': worker_id,
+            'claim_token': claim_token,
+            'lease_until': now + timedelta(seconds=lease_seconds),
+        }},
+    )
+    if result.modified_count == 0:
+        return []
+    cursor = col.find({'claim_token': claim_token}, NOTIFICATION_PROJECTION).sort('created_at', 1).batch_size(limit)
+    return [doc async for doc in cursor]
+
+
+async def count_pending_notifications(limit: int = 10000) -> int:
+    """Number of notifications that are due and unclaimed (capped at ``limit``)."""
+    now = datetime.now(timezone.utc)
+    return await get_notifications_collection().count_documents(_claimable_filter(now), limit=limit)
+
+
+class TokenBucket:
+    """Async token bucket: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    @property
+    def last_used(self) -> float:
+        return self._updated
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for ``seconds`` (used after a 429)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    """Send Telegram API calls under the bot's flood limits.
+
+    Every call takes a token from a global bucket (~30 msg/s) and from the
+    target chat's bucket (~1 msg/s). ``RetryAfter`` pauses the global bucket
+    for the requested time and retries the call. ``dispatch`` fans work out
+    over a bounded pool of workers, keeping each chat's items in order.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = NOTIFICATION_GLOBAL_RATE,
+        per_chat_rate: float = NOTIFICATION_PER_CHAT_RATE,
+        workers: int = NOTIFICATION_WORKERS,
+        max_flood_retries: int = NOTIFICATION_MAX_FLOOD_RETRIES,
+    ):
+        self.per_chat_rate = per_chat_rate
+        self.workers = workers
+        self.max_flood_retries = max_flood_retries
+        self._global = TokenBucket(global_rate)
+        self._chats: Dict[Any, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Idle chat buckets are full anyway; drop them
+                cutoff = time.monotonic() - 60
+                self._chats = {k: b for k, b in self._chats.items() if b.last_used > cutoff}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        return bucket
+
+    async def call(self, chat_id: Any, request: Callable[[], Awaitable[Any]]) -> Any:
+        """Run one Telegram request for ``chat_id`` once both buckets allow it."""
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire()
+            try:
+                return await request()
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_flood_retries:
+                    raise
+                logger.warning(f"Flood limit hit for chat {chat_id}, retrying in {e.retry_after}s")
+                self._global.pause(float(e.retry_after))
+
+    async def dispatch(
+        self,
+        items: List[Dict[str, Any]],
+        handler: Callable[[Dict[str, Any]], Awaitable[None]],
+        key: str = 'user_id',
+    ) -> None:
+        """Run ``handler`` for every item with at most ``workers`` chats in flight."""
+        by_chat: Dict[Any, List[Dict[str, Any]]] = {}
+        for item in items:
+            by_chat.setdefault(item.get(key), []).append(item)
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_items in by_chat.values():
+            queue.put_nowait(chat_items)
+
+        async def worker() -> None:
+            while True:
+                try:
+                    chat_items = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                for item in chat_items:
+                    try:
+                        await handler(item)
+                    except Exception as e:
+                        logger.error(f"Unexpected error dispatching notification: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(by_chat)))))
+
+
+def _process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
     try:
-        # Get order details to find the original message
-        orders_col = get_orders_collection()
-        order = await orders_col.find_one({'_id': order_id})
-        
-        if not order:
-            logger.warning(f"Order {order_id} not found for message editing")
-            return False
-        
-        # For now, we'll use a simple approach: try to edit the last message
-        # In a more sophisticated implementation, you'd store message IDs
-        # and track which message to edit
-        
-        # Get recent messages from the user's chat
-        # This is a simplified approach - in production you'd want to store message IDs
-        try:
-            # Try to send the updated message
-            # The client will see it as an update to their order status
-            await bot.send_message(
-                chat_id=user_id,
-                text=new_message,
-                parse_mode='HTML'
-            )
-            return True
-        except Exception as e:
-            logger.error(f"Failed to edit message for order {order_id}: {e}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Error in edit_order_status_message: {e}")
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
+    except PermissionError:
+        return True
+    return True
 
 
-async def send_pending_notifications(bot: Bot) -> None:
-    """Send all pending notifications to clients."""
-    try:
-        col = get_notifications_collection()
-        # Find all unsent notifications (sent: false) that are NOT admin notifications
-        cursor = col.find({
-            'sent': False,
-            'status': {'$nin': ['preorder', 'card_payment_verification']}
-        }).sort('created_at', 1)
-        notifications = [doc async for doc in cursor]
-        
-        if not notifications:
+class AckBatcher:
+    """Collect notification acknowledgements and write them with bulk_write.
+
+    Sent acks are appended to a local log (``log_path``) the moment Telegram
+    confirms delivery, before they are batched, so a crash between delivery
+    and the MongoDB write cannot lose them: ``recover`` replays the log on
+    the next start. The log is fsynced once per batch and, after each
+    successful flush, atomically replaced by one holding only the acks still
+    pending. Failed acks are not logged - losing one only means the
+    notification is retried.
+
+    Each process has its own log. ``recover`` also replays the logs of
+    processes that are no longer running (``notification_acks.<pid>.jsonl``
+    next to ours).
+    """
+
+    def __init__(
+        self,
+        log_path: str = NOTIFICATION_ACK_LOG,
+        batch_size: int = NOTIFICATION_ACK_BATCH_SIZE,
+        flush_interval: float = NOTIFICATION_ACK_FLUSH_INTERVAL,
+    ):
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._sent: List[Dict[str, Any]] = []
+        self._failed: List[Dict[str, Any]] = []
+        self._dead: List[Dict[str, Any]] = []
+        self._log = None
+        self._lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _open_log(self):
+        if self._log is None:
+            self._log = open(self.log_path, 'a', encoding='utf-8')
+        return self._log
+
+    def record_sent(self, notification_id: Any) -> None:
+        record = {'_id': notification_id, 'sent_at': datetime.now(timezone.utc)}
+        log = self._open_log()
+        log.write(json_util.dumps(record) + '\n')
+        # Reaches the OS page cache now; survives a process crash
+        log.flush()
+        self._sent.append(record)
+        self._schedule_flush()
+
+    def record_coalesced(self, notification_id: Any, superseded_by: Any) -> None:
+        """Retire a status notification replaced by a newer one for the same order.
+
+        Logged like a sent ack: replaying a stale status after the newer one
+        was delivered would confuse the customer.
+        """
+        record = {
+            '_id': notification_id,
+            'sent_at': datetime.now(timezone.utc),
+            'coalesced': True,
+            'superseded_by': superseded_by,
+        }
+        log = self._open_log()
+        log.write(json_util.dumps(record) + '\n')
+        log.flush()
+        self._sent.append(record)
+        self._schedule_flush()
+
+    def pending_ids(self) -> set:
+        """Ids delivered but not yet acknowledged in MongoDB."""
+        return {r['_id'] for r in self._sent}
+
+    def record_failed(self, notification_id: Any, error: str, attempts: int = 1) -> None:
+        """Schedule a retry after exponential backoff."""
+        now = datetime.now(timezone.utc)
+        self._failed.append({
+            '_id': notification_id,
+            'error': error,
+            'failed_at': now,
+            'attempts': attempts,
+            'next_attempt_at': now + timedelta(seconds=retry_delay(attempts)),
+        })
+        self._schedule_flush()
+
+    def record_dead(self, notification: Dict[str, Any], reason: str) -> None:
+        """Move a notification to the dead-letter collection."""
+        dead = dict(notification)
+        for field in ('claimed_by', 'claim_token', 'lease_until'):
+            dead.pop(field, None)
+        dead['dead_reason'] = reason
+        dead['dead_at'] = datetime.now(timezone.utc)
+        self._dead.append(dead)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if len(self._sent) + len(self._failed) + len(self._dead) >= self.batch_size:
+            delay = 0.0
+        elif self._flush_task is None or self._flush_task.done():
+            delay = self.flush_interval
+        else:
             return
-            
-        logger.info(f"Processing {len(notifications)} pending notifications")
-        
-        for notification in notifications:
-            try:
-                user_id = notification.get('user_id')
-                message = notification.get('message', '')
-                notification_id = notification.get('_id')
-                edit_message = notification.get('edit_message', False)
-                order_id = notification.get('order_id')
-                
-                if not user_id or not message:
-                    logger.warning(f"Invalid notification data: {notification}")
-                    continue
-                
-                # Check if this is a message edit request
-                if edit_message and order_id:
-                    # Try to edit existing message instead of sending new one
-                    success = await edit_order_status_message(bot, user_id, order_id, message)
-                    if success:
-                        logger.info(f"Order status message edited for user {user_id}, order {order_id}")
-                    else:
-                        # Fallback to sending new message
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=message,
-                            parse_mode='HTML'
-                        )
-                        logger.info(f"Fallback notification sent to user {user_id}")
-                else:
-                    # Send new message
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=message,
-                        parse_mode='HTML'
-                    )
-                    logger.info(f"Notification sent to user {user_id}")
-                
-                # Mark as sent
-                await col.update_one(
-                    {'_id': notification_id},
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            return
+        self._flush_task = None
+        await self.flush()
+
+    def _fsync_log(self) -> None:
+        if self._log is not None:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def _rewrite_log(self, records: List[Dict[str, Any]]) -> None:
+        """Replace the log by one holding only ``records`` (runs in a thread).
+
+        The new log is fsynced under a temporary name and swapped in with
+        os.replace, so a crash leaves either the old or the new log intact.
+        """
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json_util.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_path)
+
+    def _reopen_log(self, records: List[Dict[str, Any]]) -> None:
+        """Switch to the rewritten log, adding acks recorded during the rewrite."""
+        if self._log is not None:
+            # Still points at the replaced file
+            self._log.close()
+            self._log = None
+        if records:
+            log = self._open_log()
+            for record in records:
+                log.write(json_util.dumps(record) + '\n')
+            log.flush()
+
+    async def flush(self) -> None:
+        """Write all collected acknowledgements as one unordered bulk_write."""
+        async with self._lock:
+            sent, failed, dead = self._sent, self._failed, self._dead
+            if not sent and not failed and not dead:
+                return
+            self._sent, self._failed, self._dead = [], [], []
+            ops = [
+                UpdateOne(
+                    {'_id': r['_id']},
                     {
-                        '$set': {
-                            'sent': True,
-                            'sent_at': datetime.now(timezone.utc)
-                        }
-                    }
+                        '$set': {'sent': True, **{k: v for k, v in r.items() if k != '_id'}},
+                        '$unset': {'claimed_by': '', 'claim_token': '', 'lease_until': ''},
+                    },
                 )
-                
-            except TelegramError as e:
-                logger.error(f"Failed to send notification to user {user_id}: {e}")
-                # Mark as failed
-                await col.update_one(
-                    {'_id': notification_id},
+                for r in sent
+            ]
+            ops += [
+                UpdateOne(
+                    {'_id': r['_id']},
                     {
                         '$set': {
                             'sent': False,
-                            'error': str(e),
-                            'failed_at': datetime.now(timezone.utc)
-                        }
-                    }
+                            'error': r['error'],
+                            'failed_at': r['failed_at'],
+                            'attempts': r['attempts'],
+                            'next_attempt_at': r['next_attempt_at'],
+                        },
+                        # Release the lease; next_attempt_at now gates the retry
+                        '$unset': {'claimed_by': '', 'claim_token': '', 'lease_until': ''},
+                    },
                 )
+                for r in failed
+            ]
+            ops += [DeleteOne({'_id': d['_id']}) for d in dead]
+            try:
+                await asyncio.to_thread(self._fsync_log)
+                if dead:
+                    # Copy before deleting; a retried copy hits the unique _id and is skipped
+                    try:
+                        await get_dead_notifications_collection().insert_many(dead, ordered=False)
+                    except BulkWriteError as e:
+                        if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                            raise
+                await get_notifications_collection().bulk_write(ops, ordered=False)
             except Exception as e:
-                logger.error(f"Unexpected error processing notification: {e}")
+                logger.error(f"Error writing {len(ops)} notification acks: {e}")
+                # Every operation is idempotent, so the whole batch is simply retried
+                self._sent = sent + self._sent
+                self._failed = failed + self._failed
+                self._dead = dead + self._dead
+                return
+            # Acks recorded meanwhile go to the old log and are carried over
+            pending = list(self._sent)
+            await asyncio.to_thread(self._rewrite_log, pending)
+            self._reopen_log(self._sent[len(pending):])
+            logger.debug(f"Wrote {len(sent)} sent / {len(failed)} failed / {len(dead)} dead notification acks")
+
+    def _read_log(self, path: str) -> List[Dict[str, Any]]:
+        records = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json_util.loads(line))
+                except ValueError:
+                    logger.warning(f"Skipping corrupt notification ack line: {line[:80]}")
+        return records
+
+    def _orphaned_logs(self) -> List[str]:
+        """Ack logs next to ours whose process is no longer running."""
+        directory = os.path.dirname(self.log_path) or '.'
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        orphans = []
+        for name in names:
+            path = os.path.join(directory, name)
+            if not (name.startswith('notification_acks') and name.endswith('.jsonl')):
+                continue
+            if os.path.abspath(path) == os.path.abspath(self.log_path):
+                continue
+            pid = name[len('notification_acks'):-len('.jsonl')].lstrip('.')
+            if pid.isdigit() and _process_alive(int(pid)):
+                continue
+            # Logs without a pid predate per-process logs
+            orphans.append(path)
+        return orphans
+
+    def _adopt_orphaned_logs(self) -> None:
+        """Move the acks of dead processes into our own log."""
+        for path in self._orphaned_logs():
+            try:
+                records = self._read_log(path)
+            except FileNotFoundError:
+                # Another replica adopted it first
+                continue
+            if records:
+                log = self._open_log()
+                for record in records:
+                    log.write(json_util.dumps(record) + '\n')
+                self._fsync_log()
+                logger.info(f"Adopted {len(records)} notification acks from {path}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def recover(self) -> None:
+        """Replay acks left in our log and in those of dead processes."""
+        # Acks are idempotent, so a log adopted twice does no harm
+        await asyncio.to_thread(self._adopt_orphaned_logs)
+        if not os.path.exists(self.log_path):
+            return
+        self._sent.extend(await asyncio.to_thread(self._read_log, self.log_path))
+        if self._sent:
+            logger.info(f"Replaying {len(self._sent)} notification acks from {self.log_path}")
+            await self.flush()
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        await self.flush()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+ack_batcher = AckBatcher()
+
+
+async def edit_order_status_message(
+    bot: Bot,
+    user_id: int,
+    order_id: str,
+    new_message: str,
+    dispatcher: Optional[NotificationDispatcher] = None,
+    message_id: Optional[int] = None,
+) -> bool:
+    """Edit the order's stored status message in place.
+
+    ``message_id`` is the confirmation message saved on the order at
+    order_confirm time (carried on the notification, so no order read is
+    needed). Returns False when there is nothing to edit or the edit fails,
+    so the caller can send a new message instead.
+    """
+    if not message_id:
+        return False
+    try:
+        dispatcher = dispatcher or NotificationDispatcher()
+        await dispatcher.call(user_id, lambda: bot.edit_message_text(
+            chat_id=user_id,
+            message_id=message_id,
+            text=new_message,
+            parse_mode='HTML'
+        ))
+        return True
+    except BadRequest as e:
+        if 'message is not modified' in e.message.lower():
+            return True
+        logger.warning(f"Failed to edit message for order {order_id}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Failed to edit message for order {order_id}: {e}")
+        return False
+
+
+async def _remember_status_message(order_id: Any, message_id: int) -> None:
+    """Point the order at the newest status message so later updates edit it."""
+    try:
+        await get_orders_collection().update_one(
+            {'_id': order_id},
+            {'$set': {'status_message_id': message_id}}
+        )
+    except Exception as e:
+        logger.error(f"Error storing status message id for order {order_id}: {e}")
+
+
+async def _deliver_notification(bot: Bot, notification: Dict[str, Any], dispatcher: NotificationDispatcher) -> None:
+    """Send (or edit) the Telegram message for one notification."""
+    user_id = notification.get('user_id')
+    message = notification.get('message', '')
+    edit_message = notification.get('edit_message', False)
+    order_id = notification.get('order_id')
+    
+    # Check if this is a message edit request
+    if edit_message and order_id:
+        # Try to edit existing message instead of sending new one
+        success = await edit_order_status_message(
+            bot, user_id, order_id, message, dispatcher,
+            message_id=notification.get('message_id'),
+        )
+        if success:
+            logger.info(f"Order status message edited for user {user_id}, order {order_id}")
+        else:
+            # Fallback to sending new message
+            sent = await dispatcher.call(user_id, lambda: bot.send_message(
+                chat_id=user_id,
+                text=message,
+                parse_mode='HTML'
+            ))
+            logger.info(f"Fallback notification sent to user {user_id}")
+            if sent is not None:
+                await _remember_status_message(order_id, sent.message_id)
+    else:
+        # Send new message
+        await dispatcher.call(user_id, lambda: bot.send_message(
+            chat_id=user_id,
+            text=message,
+            parse_mode='HTML'
+        ))
+        logger.info(f"Notification sent to user {user_id}")
+
+
+def coalesce_notifications(notifications: List[Dict[str, Any]], acks: AckBatcher) -> List[Dict[str, Any]]:
+    """Keep only the newest status notification per order.
+
+    ``notifications`` is ordered by created_at. Older notifications for an
+    order that has a newer one in the same batch are marked coalesced and
+    dropped, so a customer gets one message instead of a burst.
+    """
+    newest: Dict[Any, Dict[str, Any]] = {}
+    for notification in notifications:
+        order_id = notification.get('order_id')
+        if order_id is not None:
+            newest[order_id] = notification
+
+    result = []
+    coalesced = 0
+    for notification in notifications:
+        order_id = notification.get('order_id')
+        latest = newest.get(order_id) if order_id is not None else None
+        if latest is not None and latest is not notification:
+            acks.record_coalesced(notification.get('_id'), latest.get('_id'))
+            coalesced += 1
+            continue
+        result.append(notification)
+    if coalesced:
+        logger.info(f"Coalesced {coalesced} superseded status notifications")
+    return result
+
+
+async def drop_superseded_notifications(
+    notifications: List[Dict[str, Any]],
+    acks: AckBatcher,
+) -> List[Dict[str, Any]]:
+    """Drop notifications older than one already sent or claimed for the order.
+
+    A claim can split an order's notifications across batches (the fresh
+    share takes the newest ones first), and a failed notification is retried
+    after newer ones went out. Delivering such a stale status would
+    overwrite the newer one on the order card, so it is marked coalesced
+    instead.
+    """
+    order_ids = list({n['order_id'] for n in notifications if n.get('order_id') is not None})
+    if not order_ids:
+        return notifications
+    now = datetime.now(timezone.utc)
+    cursor = get_notifications_collection().find(
+        {
+            'order_id': {'$in': order_ids},
+            '_id': {'$nin': [n.get('_id') for n in notifications]},
+            '$or': [{'sent': True}, {'lease_until': {'$gt': now}}],
+        },
+        {'order_id': 1, 'created_at': 1},
+    )
+    newest: Dict[Any, Dict[str, Any]] = {}
+    async for doc in cursor:
+        current = newest.get(doc.get('order_id'))
+        if doc.get('created_at') is not None and (current is None or doc['created_at'] > current['created_at']):
+            newest[doc['order_id']] = doc
+
+    result = []
+    for notification in notifications:
+        latest = newest.get(notification.get('order_id'))
+        created_at = notification.get('created_at')
+        if latest is not None and created_at is not None and created_at < latest['created_at']:
+            acks.record_coalesced(notification.get('_id'), latest.get('_id'))
+            continue
+        result.append(notification)
+    if len(result) < len(notifications):
+        logger.info(f"Dropped {len(notifications) - len(result)} notifications superseded by newer ones")
+    return result
+
+
+async def send_pending_notifications(
+    bot: Bot,
+    dispatcher: Optional[NotificationDispatcher] = None,
+    acks: Optional[AckBatcher] = None,
+    max_per_tick: int = NOTIFICATION_MAX_PER_TICK,
+) -> Dict[str, Any]:
+    """Send pending notifications to clients.
+
+    Work is claimed in batches of NOTIFICATION_CLAIM_BATCH and capped at
+    ``max_per_tick``, so memory stays flat however large the backlog is.
+    Returns ``{'claimed': n, 'sent': n, 'more': bool}``: ``sent`` counts
+    messages Telegram accepted, and ``more`` is True when the last claim
+    came back full, i.e. more notifications are probably waiting.
+    """
+    acks = acks or ack_batcher
+    dispatcher = dispatcher or NotificationDispatcher()
+    claimed = 0
+    sent = 0
+    more = False
+    
+    async def process(notification: Dict[str, Any]) -> None:
+        nonlocal sent
+        user_id = notification.get('user_id')
+        notification_id = notification.get('_id')
+        try:
+            if not user_id or not notification.get('message'):
+                logger.warning(f"Invalid notification data: {notification}")
+                return
+            
+            await _deliver_notification(bot, notification, dispatcher)
+            
+            # Mark as sent (logged locally now, written in the next batch)
+            acks.record_sent(notification_id)
+            sent += 1
+            
+        except TelegramError as e:
+            attempts = notification.get('attempts', 0) + 1
+            reason = permanent_failure_reason(e)
+            if reason is None and attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                reason = f"max_attempts: {e}"
+            if reason:
+                logger.warning(f"Dead-lettering notification {notification_id} for user {user_id}: {reason}")
+                acks.record_dead(notification, reason)
+            else:
+                logger.error(f"Failed to send notification to user {user_id} (attempt {attempts}): {e}")
+                # Mark as failed; retried after exponential backoff
+                acks.record_failed(notification_id, str(e), attempts)
+    
+    try:
+        while claimed < max_per_tick:
+            limit = min(NOTIFICATION_CLAIM_BATCH, max_per_tick - claimed)
+            # Claim unsent client notifications under a lease so that other
+            # replicas skip them; expired leases are picked up again
+            notifications = await claim_notifications(limit=limit)
+            more = len(notifications) >= limit
+            if not notifications:
+                break
+            claimed += len(notifications)
+            # Skip deliveries whose ack has not reached MongoDB yet
+            unacked = acks.pending_ids()
+            notifications = [n for n in notifications if n.get('_id') not in unacked]
+            
+            notifications = coalesce_notifications(notifications, acks)
+            notifications = await drop_superseded_notifications(notifications, acks)
+            
+            if notifications:
+                logger.info(f"Processing {len(notifications)} pending notifications")
+                await dispatcher.dispatch(notifications, process)
+            
+            # Acks must land before the next claim, or delivered items are re-selected
+            await acks.flush()
+            if not more:
+                break
                 
     except Exception as e:
         logger.error(f"Error in send_pending_notifications: {e}")
+    finally:
+        await acks.flush()
+    return {'claimed': claimed, 'sent': sent, 'more': more}
 
 
 # Admin notification functions removed from client bot
 # These should only exist in the admin bot
 
 class NotificationChecker:
-    """Background task to check and send notifications periodically."""
+    """Background task to check and send notifications periodically.
+
+    The polling interval adapts to the queue: it drops to ``min_interval``
+    while notifications keep arriving and doubles on every idle tick up to
+    ``interval``. Each sleep is jittered so replicas do not poll in lockstep.
+    Notifications queued in this process wake the checker at once (``wake``).
+    Current interval and backlog are published in ``metrics`` (and in
+    bot_data['notification_metrics']).
+    """
     
-    def __init__(self, bot: Bot, interval: int = 30, bot_data: Optional[Dict[str, Any]] = None):
+    def __init__(
+        self,
+        bot: Bot,
+        interval: float = NOTIFICATION_MAX_INTERVAL,
+        bot_data: Optional[Dict[str, Any]] = None,
+        min_interval: float = NOTIFICATION_MIN_INTERVAL,
+        jitter: float = NOTIFICATION_POLL_JITTER,
+    ):
         self.bot = bot
-        self.interval = interval
-        self.bot_data = bot_data or {}
+        self.max_interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.interval = self.min_interval
+        self.jitter = jitter
+        self.bot_data = bot_data if bot_data is not None else {}
+        self.dispatcher = NotificationDispatcher()
+        self.acks = ack_batcher
+        self.metrics: Dict[str, Any] = {
+            'interval': self.interval,
+            'backlog': 0,
+            'last_batch': 0,
+            'sent_total': 0,
+            'last_poll_at': None,
+        }
+        self.bot_data['notification_metrics'] = self.metrics
+        self._wakeup = asyncio.Event()
         self._task: Optional[asyncio.Task] = None
         self._running = False
     
+    def wake(self) -> None:
+        """Deliver pending notifications now instead of at the next poll."""
+        self._wakeup.set()
+    
     async def start(self) -> None:
         """Start the notification checker background task."""
+        global _active_checker
         if self._running:
             return
         
+        try:
+            await self.acks.recover()
+        except Exception as e:
+            logger.error(f"Error replaying notification acks: {e}")
+        
         self._running = True
         self._task = asyncio.create_task(self._run())
+        _active_checker = self
         logger.info("Notification checker started")
     
     async def stop(self) -> None:
         """Stop the notification checker background task."""
+        global _active_checker
         self._running = False
+        if _active_checker is self:
+            _active_checker = None
         if self._task:
             self._task.cancel()
             try:
                 await self._task
             except asyncio.CancelledError:
                 pass
+        await self.acks.close()
         logger.info("Notification checker stopped")
     
+    async def _tick(self) -> None:
+        # Process client notifications only
+        # Admin notifications should be handled by admin bot
+        # Availability is kept fresh by AvailabilityWatcher
+        result = await send_pending_notifications(self.bot, self.dispatcher, self.acks)
+        claimed = result['claimed']
+        backlog = 0
+        if result['more']:
+            # The last claim came back full, so more is waiting; measure how much
+            try:
+                backlog = await count_pending_notifications()
+            except Exception as e:
+                logger.error(f"Error counting pending notifications: {e}")
+                backlog = NOTIFICATION_CLAIM_BATCH
+        
+        if claimed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        
+        self.metrics.update({
+            'interval': self.interval,
+            'backlog': backlog,
+            'last_batch': claimed,
+            'sent_total': self.metrics['sent_total'] + result['sent'],
+            'last_poll_at': datetime.now(timezone.utc),
+        })
+        if claimed:
+            logger.info(f"Notification queue: batch={claimed}, backlog={backlog}, next poll in {self.interval:.1f}s")
+    
+    def _next_delay(self) -> float:
+        spread = self.interval * self.jitter
+        return max(0.0, self.interval + random.uniform(-spread, spread))
+    
     async def _run(self) -> None:
-        """Main loop for checking notifications and refreshing availability."""
+        """Main loop for checking notifications."""
         while self._running:
+            # Clear before claiming so a wake() during the tick is not lost
+            self._wakeup.clear()
             try:
-                # Process client notifications only
-                # Admin notifications should be handled by admin bot
-                await send_pending_notifications(self.bot)
-                
-                # Refresh availability data from MongoDB
-                # This ensures the bot picks up admin changes without restart
-                try:
-                    availability = await get_availability_dict()
-                    if availability and self.bot_data is not None:
-                        self.bot_data['avail'] = availability
-                        logger.debug(f"Availability refreshed: {len(availability)} items")
-                except Exception as e:
-                    logger.error(f"Error refreshing availability: {e}")
-                    
+                await self._tick()
             except Exception as e:
                 logger.error(f"Error in notification checker loop: {e}")
+                self.interval = min(self.interval * 2, self.max_interval)
             
-            # Wait for next check
+            # Wait for next check (or a wake-up)
             try:
-                await asyncio.sleep(self.interval)
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_delay())
+            except asyncio.TimeoutError:
+                pass
             except asyncio.CancelledError:
                 break
+
+
+_active_checker: Optional[NotificationChecker] = None
+
+
+def wake_notification_checker() -> None:
+    """Wake this process's running NotificationChecker, if any."""
+    if _active_checker is not None:
+        _active_checker.wake()
@@ -4,6 +4,10 @@ import logging
 import json
 import os
 import re
+import uuid
+import asyncio
+import hashlib
+from collections import OrderedDict
 from datetime import datetime, timezone
 from telegram import (
     ReplyKeyboardMarkup,
@@ -18,9 +22,13 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, ConnectionFailure
 from config import (
     WORK_START_HOUR,
-    WORK_END_HOUR
+    WORK_END_HOUR,
+    ORDER_STATUS_TRANSACTIONS,
+    ORDER_SIDE_EFFECT_TIMEOUT,
 )
 from handlers.common import (
     main_menu,
@@ -31,7 +39,11 @@ from handlers.common import (
     get_lang_text,
 )
 from .catalog import PRICES, DISPLAY_NAMES, SHORT_NAMES, SAMSA_KEYS, PACKAGING_KEYS
-from .mongo import get_orders_collection, get_temp_carts_collection
+from .mongo import get_orders_collection, get_availability_dict
+from .cart_store import temp_cart_store
+from .outbox import insert_order_with_event, publish_order_event
+from .journal import order_journal
+from .notification import wake_notification_checker
 
 # Conversation states
 ITEM_SELECT, ITEM_EDIT, PACKAGING_SELECT, NAME, PHONE, ADDRESS, DELIVERY, TIME_CHOICE, PAYMENT, VERIFY_PAYMENT, CONFIRM = range(11)
@@ -127,6 +139,16 @@ SIDE_OR_FINISH_PATTERN = _pattern_from_values(
 )
 
 
+async def get_current_availability(context) -> dict:
+    """Return the shared availability snapshot (cached, no DB read while fresh)."""
+    if context.bot_data.get('mongodb_available', True):
+        try:
+            return await get_availability_dict()
+        except Exception as e:
+            logging.error(f"Error loading availability snapshot: {e}")
+    return context.bot_data.get('avail', {})
+
+
 async def remind_unfinished(context):
     # Placeholder for sending reminders about unfinished orders
     pass
@@ -235,9 +257,10 @@ async def order_start(update, context):
             return ConversationHandler.END
         
         # Create menu buttons - one per row for easy clicking
+        avail = await get_current_availability(context)
         available_items = [
             [InlineKeyboardButton(f"{get_short_name(context, k)} - {PRICES[k]:,} сум", callback_data=f'samsa:{k}')]
-            for k in SAMSA_KEYS if context.bot_data['avail'].get(k, False)
+            for k in SAMSA_KEYS if avail.get(k, False)
         ]
         
         if not available_items:
@@ -316,7 +339,8 @@ async def select_samsa(update, context):
         key = q.data.split(':', 1)[1]
         
         # Check if item is available
-        if not context.bot_data.get('avail', {}).get(key, False):
+        avail = await get_current_availability(context)
+        if not avail.get(key, False):
             await q.answer(
                 get_lang_text(
                     context,
@@ -466,9 +490,10 @@ async def start_new_cart(update, context):
             return ConversationHandler.END
         
         # Create menu buttons
+        avail = await get_current_availability(context)
         available_items = [
             [InlineKeyboardButton(f"{get_short_name(context, k)} - {PRICES[k]:,} сум", callback_data=f'samsa:{k}')]
-            for k in SAMSA_KEYS if context.bot_data['avail'].get(k, False)
+            for k in SAMSA_KEYS if avail.get(k, False)
         ]
         
         if not available_items:
@@ -663,9 +688,10 @@ async def back_to_menu(update, context):
     await q.answer()
     
     # Show menu of samsa types as inline buttons - one per row for easy clicking
+    avail = await get_current_availability(context)
     available_items = [
         [InlineKeyboardButton(f"{get_short_name(context, k)} — {PRICES[k]:,} сум", callback_data=f'samsa:{k}')]
-        for k in SAMSA_KEYS if context.bot_data['avail'].get(k, False)
+        for k in SAMSA_KEYS if avail.get(k, False)
     ]
     
     # Add "Done" button if there are items in cart
@@ -780,8 +806,9 @@ async def show_packaging_menu(update, context):
 
     # Create packaging menu with all options as inline buttons
     packaging_buttons = []
+    avail = await get_current_availability(context)
     for key in PACKAGING_KEYS:
-        if context.bot_data['avail'].get(key, False):
+        if avail.get(key, False):
             packaging_buttons.append([
                 InlineKeyboardButton(
                     f"{get_short_name(context, key)} (+{PRICES[key]:,} сум)",
@@ -848,7 +875,8 @@ async def select_packaging(update, context):
     key = q.data.split(':', 1)[1]
     
     # Check if packaging is available
-    if not context.bot_data.get('avail', {}).get(key, False):
+    avail = await get_current_availability(context)
+    if not avail.get(key, False):
         await q.answer(
             get_lang_text(
                 context,
@@ -1436,12 +1464,96 @@ async def show_summary_and_confirm(update, context):
         f"⏰ <b>{context.user_data.get('time', '—')}</b>"
     )
     context.user_data['summary'] = summary
+    # Identifies this checkout; kept until the order succeeds so a retry reuses it
+    context.user_data.setdefault('checkout_nonce', uuid.uuid4().hex)
     confirm_text = get_lang_text(context, "Подтвердить", "Tasdiqlash")
     cancel_text = get_lang_text(context, "Отменить", "Bekor qilish")
     kb = ReplyKeyboardMarkup([[confirm_text, cancel_text]], one_time_keyboard=True, resize_keyboard=True)
     await update.message.reply_text(summary, reply_markup=kb, parse_mode='HTML')
 
 
+# Fields of the checkout that make two submissions the same order
+_SNAPSHOT_FIELDS = ('items', 'total', 'delivery', 'time', 'method', 'contact',
+                    'customer_name', 'customer_phone', 'customer_address')
+
+# Recently submitted idempotency keys -> future of the order _id
+_submissions: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+_SUBMISSIONS_KEPT = 1000
+
+
+def order_idempotency_key(user_id, user_data: dict) -> str:
+    """sha256 of the user, the checkout nonce and the cart snapshot."""
+    nonce = user_data.setdefault('checkout_nonce', uuid.uuid4().hex)
+    snapshot = {field: user_data.get(field) for field in _SNAPSHOT_FIELDS}
+    raw = json.dumps([str(user_id), nonce, snapshot], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+async def submit_order(order_doc: dict):
+    """Insert the order once per idempotency key.
+
+    Returns ``(order_id, created, event_written)``; the outbox event of a
+    new order is left to the caller when it was not written transactionally.
+
+    A repeated submission of the same key in this process waits for (or
+    reuses) the first one; across processes the unique index on
+    orders.idempotency_key rejects the duplicate and the existing order
+    is returned instead.
+    """
+    key = order_doc['idempotency_key']
+    future = _submissions.get(key)
+    if future is not None and not (future.done() and future.exception() is not None):
+        return await asyncio.shield(future), False, True
+
+    future = asyncio.get_running_loop().create_future()
+    _submissions[key] = future
+    while len(_submissions) > _SUBMISSIONS_KEPT:
+        _submissions.popitem(last=False)
+    try:
+        try:
+            order_id, event_written = await insert_order_with_event(order_doc, defer_event=True)
+            created = True
+        except DuplicateKeyError:
+            existing = await get_orders_collection().find_one({'idempotency_key': key}, {'_id': 1})
+            if existing is None:
+                raise
+            order_id, created, event_written = existing['_id'], False, True
+            logging.info(f"Duplicate order submission ignored, existing order {order_id}")
+    except Exception as e:
+        future.set_exception(e)
+        # Nobody else may be waiting; mark the exception as retrieved
+        future.exception()
+        raise
+    future.set_result(order_id)
+    return order_id, created, event_written
+
+
+async def _bounded(step: str, coro, timeout: float = ORDER_SIDE_EFFECT_TIMEOUT):
+    """Run a secondary post-confirm step; failures and timeouts are logged, never raised."""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Post-confirm step '{step}' timed out after {timeout}s")
+    except Exception as e:
+        logging.error(f"Post-confirm step '{step}' failed: {e}")
+
+
+async def update_user_stats(user_id, order_id, total: int) -> None:
+    """Count the order in the customer's user_stats document."""
+    from .mongo import get_user_stats_collection
+
+    now = datetime.now(timezone.utc)
+    await get_user_stats_collection().update_one(
+        {'_id': user_id},
+        {
+            '$inc': {'orders_count': 1, 'total_spent': total},
+            '$set': {'last_order_id': order_id, 'last_order_at': now},
+            '$setOnInsert': {'first_order_at': now},
+        },
+        upsert=True,
+    )
+
+
 async def order_confirm(update, context):
     confirm_text = get_lang_text(context, "Подтвердить", "Tasdiqlash")
     cancel_text = get_lang_text(context, "Отменить", "Bekor qilish")
@@ -1471,6 +1583,7 @@ async def order_confirm(update, context):
 
             payment_method = context.user_data.get('method', '')
             is_card_payment = payment_method.startswith('💳')
+            side_effects = []
 
             if is_card_payment:
                 if context.user_data.get('payment_verified'):
@@ -1496,64 +1609,74 @@ async def order_confirm(update, context):
                     '🙏 Buyurtmangiz uchun rahmat!\n\n🎉 Buyurtmangiz qabul qilindi! Tez orada siz bilan bogʻlanamiz.'
                 )
 
+            current_hour = datetime.now().hour
+            is_preorder = current_hour >= 22 or current_hour <= 6
+
+            order_doc = {
+                'user_id': int(uid) if uid.isdigit() else uid,
+                'items': context.user_data.get('items', {}),
+                'total': context.user_data.get('total', 0),
+                'customer_name': context.user_data.get('customer_name'),
+                'customer_phone': context.user_data.get('customer_phone'),
+                'customer_address': context.user_data.get('customer_address'),
+                'contact': context.user_data.get('contact'),
+                'delivery': context.user_data.get('delivery'),
+                'time': context.user_data.get('time'),
+                'method': payment_method,
+                'summary': context.user_data.get('summary'),
+                'status': order_status,
+                'payment_verified': context.user_data.get('payment_verified', False),
+                'payment_amount': context.user_data.get('payment_amount', 0),
+                'is_preorder': is_preorder,
+                'requires_payment_check': is_card_payment and context.user_data.get('payment_verified', False),
+                'idempotency_key': order_idempotency_key(uid, context.user_data),
+                'created_at': datetime.now(timezone.utc),
+            }
+
+            order_id = None
             if context.bot_data.get('mongodb_available', True):
-                from datetime import datetime, timezone
-
-                current_hour = datetime.now().hour
-                is_preorder = current_hour >= 22 or current_hour <= 6
-
-                order_doc = {
-                    'user_id': int(uid) if uid.isdigit() else uid,
-                    'items': context.user_data.get('items', {}),
-                    'total': context.user_data.get('total', 0),
-                    'customer_name': context.user_data.get('customer_name'),
-                    'customer_phone': context.user_data.get('customer_phone'),
-                    'customer_address': context.user_data.get('customer_address'),
-                    'contact': context.user_data.get('contact'),
-                    'delivery': context.user_data.get('delivery'),
-                    'time': context.user_data.get('time'),
-                    'method': payment_method,
-                    'summary': context.user_data.get('summary'),
-                    'status': order_status,
-                    'payment_verified': context.user_data.get('payment_verified', False),
-                    'payment_amount': context.user_data.get('payment_amount', 0),
-                    'is_preorder': is_preorder,
-                    'requires_payment_check': is_card_payment and context.user_data.get('payment_verified', False),
-                    'created_at': datetime.now(timezone.utc),
-                }
-                col = get_orders_collection()
-                await col.insert_one(order_doc)
-            else:
-                import json
-                from datetime import datetime
-                order_data = {
-                    'user_id': uid,
-                    'items': context.user_data.get('items', {}),
-                    'total': context.user_data.get('total', 0),
-                    'contact': context.user_data.get('contact'),
-                    'delivery': context.user_data.get('delivery'),
-                    'time': context.user_data.get('time'),
-                    'method': payment_method,
-                    'summary': context.user_data.get('summary'),
-                    'status': order_status,
-                    'payment_verified': context.user_data.get('payment_verified', False),
-                    'payment_amount': context.user_data.get('payment_amount', 0),
-                    'created_at': datetime.now().isoformat(),
-                }
-
-                orders_file = 'data/orders.json'
                 try:
-                    with open(orders_file, 'r', encoding='utf-8') as f:
-                        orders = json.load(f)
-                except (FileNotFoundError, json.JSONDecodeError):
-                    orders = []
-
-                orders.append(order_data)
-
-                with open(orders_file, 'w', encoding='utf-8') as f:
-                    json.dump(orders, f, ensure_ascii=False, indent=2)
-
-            await update.message.reply_text(status_message, reply_markup=context.bot_data.get('keyb', {}).get('main'))
+                    # The order and its outbox event are written together, once per checkout
+                    order_id, created, event_written = await submit_order(order_doc)
+                except ConnectionFailure as e:
+                    # MongoDB unreachable or circuit open: take the order offline;
+                    # the idempotency key drops it on replay if the write did land
+                    logging.warning(f"Order write failed, journaling it instead: {e}")
+                    await order_journal.append(order_doc)
+                    created = False
+                if created:
+                    # Secondary work runs next to the reply, each step time-boxed
+                    side_effects.append(_bounded('delete_temp_cart', delete_temp_cart(update.effective_user.id)))
+                    if not event_written:
+                        side_effects.append(_bounded('outbox', publish_order_event(order_doc)))
+                    side_effects.append(_bounded('user_stats', update_user_stats(order_doc['user_id'], order_id, order_doc['total'])))
+                else:
+                    # A double tap (or an offline order): no status message to store
+                    order_id = None
+            else:
+                # Constant-cost durable append; OrderReconciler replays it into MongoDB
+                await order_journal.append(order_doc)
+
+            async def send_confirmation():
+                await update.message.reply_text(status_message, reply_markup=context.bot_data.get('keyb', {}).get('main'))
+                if order_id is None or order_status != 'new':
+                    # Only an accepted order gets a card for status updates
+                    return
+                # Telegram can't edit a message sent with a reply keyboard, so
+                # the order card that status updates edit goes out on its own
+                card = await create_status_update_message(
+                    {**order_doc, '_id': order_id},
+                    order_status,
+                    STATUS_MESSAGES.get(order_status, f'📋 Статус заказа: {order_status}'),
+                )
+                status_card = await update.message.reply_text(card, parse_mode='HTML')
+                if status_card is not None:
+                    await _bounded('status_message_id', get_orders_collection().update_one(
+                        {'_id': order_id},
+                        {'$set': {'status_message_id': status_card.message_id}}
+                    ))
+
+            await asyncio.gather(send_confirmation(), *side_effects)
             context.user_data.clear()
         except Exception as e:
             logging.error(f"Error saving order: {e}")
@@ -1592,67 +1715,158 @@ async def order_confirm(update, context):
     return CONFIRM
 
 
+# Client-facing text for each order status
+STATUS_MESSAGES = {
+    'new': '🕐 Заказ принят',
+    'preparing': '🔄 Ваш заказ готовится!',
+    'ready': '✅ Ваш заказ готов!',
+    'delivered': '🎉 Заказ доставлен!',
+    'cancelled': '❌ Заказ отменен',
+    'confirmed': '✅ Оплата подтверждена! Заказ принят в обработку.'
+}
+
+
+async def build_status_notification(order, order_id, new_status: str, user_id: int) -> dict:
+    """Notification document for a status change, rendered from the order post-image."""
+    message = STATUS_MESSAGES.get(new_status, f'📋 Статус заказа: {new_status}')
+    now = datetime.now(timezone.utc)
+    if order:
+        # Create enhanced notification with order details for message editing
+        enhanced_message = await create_status_update_message(order, new_status, message)
+        return {
+            'user_id': user_id,
+            'order_id': order_id,
+            'status': new_status,
+            'message': enhanced_message,
+            'original_message': message,
+            'edit_message': True,  # Flag to indicate this should edit existing message
+            'message_id': order.get('status_message_id'),  # Message to edit
+            'sent': False,
+            'created_at': now
+        }
+    # Fallback to simple notification
+    return {
+        'user_id': user_id,
+        'order_id': order_id,
+        'status': new_status,
+        'message': message,
+        'edit_message': False,
+        'sent': False,
+        'created_at': now
+    }
+
+
 # Function to update order status (called by admin bot)
 async def update_order_status(order_id: str, new_status: str, user_id: int, bot):
-    """Update order status and notify client with message editing"""
+    """Update order status and notify client with message editing.
+
+    The status change is one find_one_and_update that returns the updated
+    order, and the notification is rendered from that post-image. On a
+    replica set both writes run in a single transaction.
+    """
     try:
-        from datetime import datetime, timezone
-        from .mongo import get_notifications_collection, get_orders_collection
-        
-        # Create status update notification with message editing capability
-        status_messages = {
-            'preparing': '🔄 Ваш заказ готовится!',
-            'ready': '✅ Ваш заказ готов!',
-            'delivered': '🎉 Заказ доставлен!',
-            'cancelled': '❌ Заказ отменен',
-            'confirmed': '✅ Оплата подтверждена! Заказ принят в обработку.'
-        }
+        from .mongo import get_notifications_collection, supports_transactions, start_session
         
-        message = status_messages.get(new_status, f'📋 Статус заказа: {new_status}')
-        
-        # Get order details for message editing
         orders_col = get_orders_collection()
-        order = await orders_col.find_one({'_id': order_id})
+        notifications_col = get_notifications_collection()
         
-        if order:
-            # Create enhanced notification with order details for message editing
-            enhanced_message = await create_status_update_message(order, new_status, message)
-            
-            notification_doc = {
-                'user_id': user_id,
-                'order_id': order_id,
-                'status': new_status,
-                'message': enhanced_message,
-                'original_message': message,
-                'edit_message': True,  # Flag to indicate this should edit existing message
-                'sent': False,
-                'created_at': datetime.now(timezone.utc)
-            }
+        async def apply(session=None):
+            order = await orders_col.find_one_and_update(
+                {'_id': order_id},
+                {'$set': {'status': new_status, 'updated_at': datetime.now(timezone.utc)}},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            notification_doc = await build_status_notification(order, order_id, new_status, user_id)
+            await notifications_col.insert_one(notification_doc, session=session)
+        
+        if ORDER_STATUS_TRANSACTIONS and await supports_transactions():
+            async with await start_session() as session:
+                await session.with_transaction(apply)
         else:
-            # Fallback to simple notification
-            notification_doc = {
-                'user_id': user_id,
-                'order_id': order_id,
-                'status': new_status,
-                'message': message,
-                'edit_message': False,
-                'sent': False,
-                'created_at': datetime.now(timezone.utc)
-            }
+            await apply()
+        
+        wake_notification_checker()
+        logging.info(f"Order {order_id} status updated to {new_status}")
         
+    except Exception as e:
+        logging.error(f"Error updating order status: {e}")
+
+
+async def bulk_update_order_status(transitions) -> dict:
+    """Apply many (order_id, new_status) transitions at once (called by admin bot).
+
+    Orders are updated with one bulk_write, re-read with one $in query and
+    the client notifications are queued with one insert_many. The customer
+    is taken from each order's user_id. A later pair for the same order
+    overrides an earlier one.
+
+    Returns {order_id: 'updated' | 'not_found' | 'error'}.
+    """
+    wanted = {}
+    for order_id, new_status in transitions:
+        wanted[order_id] = new_status
+    if not wanted:
+        return {}
+    
+    results = {order_id: 'error' for order_id in wanted}
+    try:
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        from .mongo import get_notifications_collection, supports_transactions, start_session
+        
+        orders_col = get_orders_collection()
         notifications_col = get_notifications_collection()
-        await notifications_col.insert_one(notification_doc)
+        order_ids = list(wanted)
+        
+        async def apply(session=None):
+            now = datetime.now(timezone.utc)
+            ops = [
+                UpdateOne({'_id': order_id}, {'$set': {'status': new_status, 'updated_at': now}})
+                for order_id, new_status in wanted.items()
+            ]
+            failed = set()
+            try:
+                await orders_col.bulk_write(ops, ordered=False, session=session)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failed.add(order_ids[error['index']])
+                    logging.error(f"Error updating order {order_ids[error['index']]}: {error.get('errmsg')}")
+            
+            orders = await orders_col.find(
+                {'_id': {'$in': [i for i in order_ids if i not in failed]}}, session=session
+            ).to_list(length=None)
+            
+            notification_docs = []
+            found = set()
+            for order in orders:
+                order_id = order['_id']
+                found.add(order_id)
+                notification_docs.append(
+                    await build_status_notification(order, order_id, wanted[order_id], order.get('user_id'))
+                )
+            if notification_docs:
+                await notifications_col.insert_many(notification_docs, ordered=False, session=session)
+            
+            for order_id in order_ids:
+                if order_id in failed:
+                    results[order_id] = 'error'
+                else:
+                    results[order_id] = 'updated' if order_id in found else 'not_found'
         
-        # Update the order status in orders collection
-        await orders_col.update_one(
-            {'_id': order_id},
-            {'$set': {'status': new_status, 'updated_at': datetime.now(timezone.utc)}}
-        )
+        if ORDER_STATUS_TRANSACTIONS and await supports_transactions():
+            async with await start_session() as session:
+                await session.with_transaction(apply)
+        else:
+            await apply()
+        wake_notification_checker()
         
-        logging.info(f"Order {order_id} status updated to {new_status}")
+        logging.info(f"Bulk status update: {sum(r == 'updated' for r in results.values())}/{len(results)} orders updated")
         
     except Exception as e:
-        logging.error(f"Error updating order status: {e}")
+        logging.error(f"Error in bulk order status update: {e}")
+    
+    return results
 
 
 async def create_status_update_message(order: dict, new_status: str, status_message: str) -> str:
@@ -1712,12 +1926,11 @@ async def noop(update, context):
 
 # Temporary cart functions
 async def save_temp_cart(user_id: int, cart_data: dict) -> bool:
-    """Save temporary cart to MongoDB"""
+    """Queue the temporary cart for a write-behind upsert to MongoDB"""
     try:
-        temp_carts_col = get_temp_carts_collection()
         cart_doc = {
             'user_id': user_id,
-            'items': cart_data.get('items', {}),
+            'items': dict(cart_data.get('items', {})),
             'total': cart_data.get('total', 0),
             'has_samsa': cart_data.get('has_samsa', False),
             'has_packaging': cart_data.get('has_packaging', False),
@@ -1725,12 +1938,8 @@ async def save_temp_cart(user_id: int, cart_data: dict) -> bool:
             'updated_at': datetime.now(timezone.utc)
         }
         
-        # Upsert (update if exists, insert if not)
-        await temp_carts_col.update_one(
-            {'user_id': user_id},
-            {'$set': cart_doc},
-            upsert=True
-        )
+        # Persisted by temp_cart_store's next bulk flush
+        temp_cart_store.save(user_id, cart_doc)
         return True
     except Exception as e:
         logging.error(f"Error saving temp cart: {e}")
@@ -1738,10 +1947,9 @@ async def save_temp_cart(user_id: int, cart_data: dict) -> bool:
 
 
 async def load_temp_cart(user_id: int) -> dict:
-    """Load temporary cart from MongoDB"""
+    """Load temporary cart through temp_cart_store's read-through cache"""
     try:
-        temp_carts_col = get_temp_carts_collection()
-        cart = await temp_carts_col.find_one({'user_id': user_id})
+        cart = await temp_cart_store.load(user_id)
         if cart:
             return {
                 'items': cart.get('items', {}),
@@ -1756,10 +1964,9 @@ async def load_temp_cart(user_id: int) -> dict:
 
 
 async def delete_temp_cart(user_id: int) -> bool:
-    """Delete temporary cart from MongoDB"""
+    """Queue deletion of the temporary cart from MongoDB"""
     try:
-        temp_carts_col = get_temp_carts_collection()
-        await temp_carts_col.delete_one({'user_id': user_id})
+        temp_cart_store.delete(user_id)
         return True
     except Exception as e:
         logging.error(f"Error deleting temp cart: {e}")
@@ -0,0 +1,312 @@
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, List
+
+import httpx
+from bson import ObjectId, json_util
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from config import (
+    OUTBOX_WEBHOOK_URL,
+    OUTBOX_SOCKET_PATH,
+    OUTBOX_TIMEOUT,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_LEASE_SECONDS,
+    OUTBOX_CONCURRENCY,
+    OUTBOX_RETRY_BASE,
+    OUTBOX_RETRY_MAX,
+)
+from .mongo import get_orders_collection, get_outbox_collection, supports_transactions, start_session
+
+logger = logging.getLogger(__name__)
+
+ORDER_CREATED = 'order.created'
+
+
+def push_configured() -> bool:
+    """True when a webhook or socket subscriber is configured for the relay."""
+    return bool(OUTBOX_WEBHOOK_URL or OUTBOX_SOCKET_PATH)
+
+
+def order_event(order_doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Outbox event announcing a new order (``order_doc`` must have an _id).
+
+    Without a push subscriber the event is only read by change stream
+    consumers, which see the insert itself; it is written as delivered so
+    the retention TTL removes it.
+    """
+    now = datetime.now(timezone.utc)
+    event = {
+        'event': ORDER_CREATED,
+        'idempotency_key': f"{ORDER_CREATED}:{order_doc['_id']}",
+        'order_id': order_doc['_id'],
+        'payload': dict(order_doc),
+        'delivered': False,
+        'attempts': 0,
+        'created_at': now,
+    }
+    if not push_configured():
+        event.update(delivered=True, delivered_at=now)
+    return event
+
+
+async def insert_order_with_event(order_doc: Dict[str, Any], defer_event: bool = False):
+    """Insert an order and its ``order.created`` outbox event.
+
+    On a replica set both documents are written in one transaction, so an
+    event exists exactly when the order does. A standalone server has no
+    transactions: the event is written right after the order (or left to
+    the caller with ``defer_event``), and if that write fails the order is
+    still found by the admin bot's status='new' query.
+
+    Returns ``(order_id, event_written)``.
+    """
+    order_doc.setdefault('_id', ObjectId())
+    orders_col = get_orders_collection()
+
+    if await supports_transactions():
+        event = order_event(order_doc)
+        outbox_col = get_outbox_collection()
+
+        async def apply(session):
+            await orders_col.insert_one(order_doc, session=session)
+            await outbox_col.insert_one(event, session=session)
+
+        async with await start_session() as session:
+            await session.with_transaction(apply)
+        outbox_relay.wake()
+        return order_doc['_id'], True
+
+    await orders_col.insert_one(order_doc)
+    if defer_event:
+        return order_doc['_id'], False
+    return order_doc['_id'], await publish_order_event(order_doc)
+
+
+async def publish_order_event(order_doc: Dict[str, Any]) -> bool:
+    """Write the outbox event of an already inserted order (idempotent)."""
+    try:
+        await get_outbox_collection().insert_one(order_event(order_doc))
+    except DuplicateKeyError:
+        return True
+    except Exception as e:
+        logger.error(f"Error writing outbox event for order {order_doc['_id']}: {e}")
+        return False
+    outbox_relay.wake()
+    return True
+
+
+def event_body(event: Dict[str, Any]) -> str:
+    """JSON (MongoDB relaxed extended JSON) sent to subscribers."""
+    return json_util.dumps({
+        'event': event['event'],
+        'idempotency_key': event['idempotency_key'],
+        'order_id': event['order_id'],
+        'created_at': event['created_at'],
+        'payload': event['payload'],
+    }, ensure_ascii=False)
+
+
+class WebhookSink:
+    """POSTs each event to an HTTP endpoint, optionally over a Unix socket.
+
+    The event's idempotency key is sent in the ``Idempotency-Key`` header;
+    any 2xx response acknowledges the event.
+    """
+
+    def __init__(self, url: str, socket_path: str = '', timeout: float = OUTBOX_TIMEOUT):
+        self.url = url or 'http://localhost/outbox'
+        self.name = f"unix:{socket_path}" if socket_path else self.url
+        transport = httpx.AsyncHTTPTransport(uds=socket_path) if socket_path else None
+        self._client = httpx.AsyncClient(timeout=timeout, transport=transport)
+
+    async def send(self, event: Dict[str, Any]) -> None:
+        response = await self._client.post(
+            self.url,
+            content=event_body(event).encode('utf-8'),
+            headers={
+                'Content-Type': 'application/json',
+                'Idempotency-Key': event['idempotency_key'],
+            },
+        )
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def configured_sinks() -> List[WebhookSink]:
+    if push_configured():
+        return [WebhookSink(OUTBOX_WEBHOOK_URL, OUTBOX_SOCKET_PATH)]
+    return []
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff in seconds after ``attempts`` failed deliveries."""
+    return min(OUTBOX_RETRY_BASE * (2 ** max(attempts - 1, 0)), OUTBOX_RETRY_MAX)
+
+
+def _due_filter(now: datetime) -> Dict[str, Any]:
+    return {
+        'delivered': False,
+        '$and': [
+            {'$or': [{'next_attempt_at': None}, {'next_attempt_at': {'$lte': now}}]},
+            {'$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+        ],
+    }
+
+
+class OutboxRelay:
+    """Background task pushing outbox events to the configured subscribers.
+
+    Delivery is at-least-once: an event is marked delivered only after every
+    sink acknowledged it, and failures are retried with exponential backoff,
+    so consumers deduplicate on ``idempotency_key``. Events are claimed under
+    a lease so several bot replicas can run the relay; a claimed batch is
+    delivered ``concurrency`` events at a time so it finishes within the
+    lease, and results are only written while our claim still holds. A new
+    order wakes the
+    relay at once; ``poll_interval`` only paces retries and events written by
+    other processes.
+    """
+
+    def __init__(
+        self,
+        sinks: Optional[List[WebhookSink]] = None,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        lease_seconds: float = OUTBOX_LEASE_SECONDS,
+        concurrency: int = OUTBOX_CONCURRENCY,
+    ):
+        self.sinks = sinks
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.concurrency = max(concurrency, 1)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    def wake(self) -> None:
+        """Deliver pending events now instead of at the next poll."""
+        self._wakeup.set()
+
+    async def start(self) -> bool:
+        """Start the relay; returns False when no subscriber is configured."""
+        if self._running:
+            return True
+        if self.sinks is None:
+            self.sinks = configured_sinks()
+        if not self.sinks:
+            logger.info("No outbox subscribers configured, relay not started")
+            return False
+
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Outbox relay started ({', '.join(s.name for s in self.sinks)})")
+        return True
+
+    async def stop(self) -> None:
+        """Stop the relay and close the sinks."""
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for sink in self.sinks or []:
+            await sink.close()
+        logger.info("Outbox relay stopped")
+
+    async def _claim(self) -> List[Dict[str, Any]]:
+        """Claim a batch of due events (same read/claim/read-back scheme as notifications)."""
+        col = get_outbox_collection()
+        now = datetime.now(timezone.utc)
+        candidates = await col.find(_due_filter(now), {'_id': 1}).sort('created_at', 1).limit(self.batch_size).to_list(length=None)
+        if not candidates:
+            return []
+        claim_token = uuid.uuid4().hex
+        claim_filter = _due_filter(now)
+        claim_filter['_id'] = {'$in': [doc['_id'] for doc in candidates]}
+        result = await col.update_many(
+            claim_filter,
+            {'$set': {'claim_token': claim_token, 'lease_until': now + timedelta(seconds=self.lease_seconds)}},
+        )
+        if not result.modified_count:
+            return []
+        return await col.find({'claim_token': claim_token}).sort('created_at', 1).to_list(length=None)
+
+    async def _deliver(self, event: Dict[str, Any]) -> Optional[str]:
+        """Send to every sink; returns an error description or None on success."""
+        results = await asyncio.gather(*(sink.send(event) for sink in self.sinks), return_exceptions=True)
+        errors = [f"{sink.name}: {r}" for sink, r in zip(self.sinks, results) if isinstance(r, Exception)]
+        return '; '.join(errors) or None
+
+    async def relay_once(self) -> int:
+        """Claim and deliver one batch; returns the number of events claimed."""
+        events = await self._claim()
+        if not events:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(event: Dict[str, Any]) -> Optional[str]:
+            async with semaphore:
+                return await self._deliver(event)
+
+        errors = await asyncio.gather(*(deliver(event) for event in events))
+        now = datetime.now(timezone.utc)
+        ops = []
+        for event, error in zip(events, errors):
+            # A lease that ran out may have been claimed again by another
+            # replica; its claim_token no longer matches and the ack is dropped
+            claimed = {'_id': event['_id'], 'claim_token': event['claim_token']}
+            if error is None:
+                ops.append(UpdateOne(
+                    claimed,
+                    {'$set': {'delivered': True, 'delivered_at': now}, '$unset': {'lease_until': '', 'claim_token': ''}},
+                ))
+            else:
+                attempts = event.get('attempts', 0) + 1
+                logger.warning(f"Outbox event {event['idempotency_key']} not delivered (attempt {attempts}): {error}")
+                ops.append(UpdateOne(
+                    claimed,
+                    {
+                        '$set': {
+                            'attempts': attempts,
+                            'last_error': error,
+                            'next_attempt_at': now + timedelta(seconds=retry_delay(attempts)),
+                        },
+                        '$unset': {'lease_until': '', 'claim_token': ''},
+                    },
+                ))
+        await get_outbox_collection().bulk_write(ops, ordered=False)
+        return len(events)
+
+    async def _run(self) -> None:
+        while self._running:
+            # Clear before reading so a wake() during delivery is not lost
+            self._wakeup.clear()
+            claimed = 0
+            try:
+                claimed = await self.relay_once()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in outbox relay: {e}")
+            if claimed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                break
+
+
+outbox_relay = OutboxRelay()
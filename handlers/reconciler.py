@@ -0,0 +1,199 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Callable, Awaitable
+
+from pymongo.errors import BulkWriteError
+
+from config import ORDERS_JOURNAL_CHECKPOINT, ORDER_REPLAY_INTERVAL, ORDER_REPLAY_BATCH
+from .mongo import get_db, get_orders_collection, get_outbox_collection, prepare_database, indexes_ready
+from .breaker import maintenance
+from .journal import OrderJournal, order_journal
+from .outbox import order_event, outbox_relay
+
+logger = logging.getLogger(__name__)
+
+
+class OrderReconciler:
+    """Background task replaying journaled offline orders into MongoDB.
+
+    Every ``interval`` seconds while the bot runs in fallback mode, it pings
+    MongoDB through the circuit breaker, which owns
+    ``bot_data['mongodb_available']``. When the bot comes back from fallback
+    mode, it syncs the indexes and seeds missing data (``prepare_database``),
+    then ``on_reconnect`` starts the services that were skipped at startup.
+    Journal records past the checkpoint are replayed whenever MongoDB is
+    available, once the indexes are in place, in unordered ``insert_many``
+    chunks of ``batch_size``; orders already in MongoDB are rejected by the
+    unique journal_id index, so a replay interrupted between the insert and
+    the checkpoint write is harmless. Replayed orders also get an
+    ``order.created`` outbox event; a chunk whose events could not be
+    written is replayed again.
+
+    The checkpoint is the journal byte offset, written atomically after
+    every chunk.
+    """
+
+    def __init__(
+        self,
+        bot_data: Optional[Dict[str, Any]] = None,
+        journal: OrderJournal = order_journal,
+        checkpoint_path: str = ORDERS_JOURNAL_CHECKPOINT,
+        interval: float = ORDER_REPLAY_INTERVAL,
+        batch_size: int = ORDER_REPLAY_BATCH,
+        on_reconnect: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.bot_data = bot_data
+        self.journal = journal
+        self.checkpoint_path = checkpoint_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_reconnect = on_reconnect
+        self._was_offline = False
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+
+    async def start(self) -> None:
+        """Start the reconciler background task."""
+        if self._running:
+            return
+
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info("Order reconciler started")
+
+    async def stop(self) -> None:
+        """Stop the reconciler background task."""
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logger.info("Order reconciler stopped")
+
+    def _load_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                offset = int(json.load(f).get('offset', 0))
+        except (FileNotFoundError, ValueError, json.JSONDecodeError):
+            return 0
+        try:
+            size = os.path.getsize(self.journal.path)
+        except OSError:
+            size = 0
+        # A journal shorter than the checkpoint was replaced; start over
+        return offset if offset <= size else 0
+
+    def _save_checkpoint(self, offset: int) -> None:
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _has_backlog(self, offset: int) -> bool:
+        try:
+            return os.path.getsize(self.journal.path) > offset
+        except OSError:
+            return False
+
+    async def _mongo_reachable(self) -> bool:
+        try:
+            await get_db().command('ping')
+            return True
+        except Exception as e:
+            logger.debug(f"MongoDB still unreachable: {e}")
+            return False
+
+    async def _insert_chunk(self, records) -> int:
+        """Insert one chunk; returns how many orders were new."""
+        failed = set()
+        try:
+            await get_orders_collection().insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != 11000:
+                    # Anything but "already replayed" must be retried
+                    raise
+                failed.add(error['index'])
+        inserted = [r for i, r in enumerate(records) if i not in failed]
+        orders = list(inserted)
+        # An earlier pass may have stopped between these orders and their events
+        keys = [records[i].get(k) for i in failed for k in ('journal_id', 'idempotency_key')]
+        keys = [k for k in keys if isinstance(k, str)]
+        if keys:
+            orders += await get_orders_collection().find(
+                {'$or': [{'journal_id': {'$in': keys}}, {'idempotency_key': {'$in': keys}}]}
+            ).to_list(length=None)
+        if orders:
+            try:
+                await get_outbox_collection().insert_many([order_event(o) for o in orders], ordered=False)
+            except BulkWriteError as e:
+                if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                    # The chunk is replayed again, so no order loses its event
+                    raise
+            outbox_relay.wake()
+        return len(inserted)
+
+    async def replay(self) -> int:
+        """Replay everything after the checkpoint; returns the number of new orders."""
+        offset = await asyncio.to_thread(self._load_checkpoint)
+        replayed = 0
+        while True:
+            records, next_offset = await self.journal.read(offset, self.batch_size)
+            if next_offset == offset:
+                break
+            if records:
+                replayed += await self._insert_chunk(records)
+            offset = next_offset
+            await asyncio.to_thread(self._save_checkpoint, offset)
+            logger.info(f"Replayed offline orders up to journal offset {offset} ({replayed} new)")
+        return replayed
+
+    def _offline(self) -> bool:
+        return self.bot_data is not None and not self.bot_data.get('mongodb_available', True)
+
+    async def _recover(self) -> None:
+        logger.info("MongoDB reachable again, new orders go to MongoDB")
+        try:
+            await prepare_database()
+        except Exception as e:
+            logger.error(f"Error preparing the database after reconnect: {e}")
+        if self.on_reconnect is not None:
+            try:
+                await self.on_reconnect()
+            except Exception as e:
+                logger.error(f"Error starting services after reconnect: {e}")
+
+    async def _run(self) -> None:
+        while self._running:
+            try:
+                offset = await asyncio.to_thread(self._load_checkpoint)
+                if self._offline():
+                    self._was_offline = True
+                    # Going through the breaker, this ping is the probe that closes it
+                    await self._mongo_reachable()
+                if not self._offline():
+                    if self._was_offline:
+                        # Back from fallback mode (through this ping or any other call)
+                        self._was_offline = False
+                        await self._recover()
+                    if self._has_backlog(offset):
+                        # Replay dedup relies on the unique journal_id/idempotency_key indexes
+                        await indexes_ready()
+                        with maintenance():
+                            replayed = await self.replay()
+                        if replayed:
+                            logger.info(f"{replayed} offline orders reached MongoDB")
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error replaying offline orders: {e}")
+            try:
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                break
@@ -0,0 +1,912 @@
+"""Local storage backends speaking the subset of the Motor API this bot uses.
+
+``STORAGE_BACKEND`` selects where ``handlers/mongo.py`` gets its client:
+
+* ``mongo``  - MongoDB through Motor (production)
+* ``sqlite`` - documents persisted in ``SQLITE_PATH`` (WAL mode)
+* ``memory`` - process memory only (benchmarks, tests)
+
+The local backends evaluate queries in memory. Filters support equality
+and the ``$eq $ne $gt $gte $lt $lte $in $nin $exists $type $not $and $or
+$nor`` operators; updates support ``$set $unset $inc $setOnInsert $min
+$max $push``. Unique, sparse and partial indexes are enforced. TTL indexes
+are accepted but never expire documents. There are no transactions, and
+change streams raise the same error as a standalone mongod, so callers take
+their existing fallback paths.
+
+The SQLite backend keeps a copy of each collection in memory. ``connect()``
+loads the stored collections at startup on the storage thread
+(``LocalDatabase.preload``); a collection first touched before that is
+loaded on first access. Every write is persisted before the call returns, on one
+dedicated thread, so writes reach the file in order without blocking the
+event loop.
+"""
+
+import copy
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+
+from bson import ObjectId, json_util
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.results import (
+    InsertOneResult,
+    InsertManyResult,
+    UpdateResult,
+    DeleteResult,
+    BulkWriteResult,
+)
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+_JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS.with_options(tz_aware=True, tzinfo=timezone.utc)
+
+
+# --- query evaluation -------------------------------------------------------
+
+def _norm(value):
+    """Naive datetimes are UTC, as in MongoDB."""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _type_rank(value) -> int:
+    # BSON comparison order
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    value = _norm(value)
+    rank = _type_rank(value)
+    if rank in (4, 5, 10):
+        return (rank, str(value))
+    if rank == 1:
+        return (rank, 0)
+    return (rank, value)
+
+
+def _freeze(value):
+    """Hashable form of a BSON value (index keys)."""
+    value = _norm(value)
+    if isinstance(value, dict):
+        return ('d',) + tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return ('l',) + tuple(_freeze(v) for v in value)
+    if isinstance(value, bool):
+        return ('b', value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _lookup(doc, path: str):
+    current = doc
+    for part in path.split('.'):
+        if isinstance(current, dict) and part in current:
+            current = current[part]
+        elif isinstance(current, list) and part.isdigit() and int(part) < len(current):
+            current = current[int(part)]
+        else:
+            return _MISSING
+    return current
+
+
+def _eq(a, b) -> bool:
+    a, b = _norm(a), _norm(b)
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    if _type_rank(a) != _type_rank(b):
+        return False
+    return a == b
+
+
+def _equals(value, target) -> bool:
+    if value is _MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return any(_eq(v, target) for v in value)
+    return _eq(value, target)
+
+
+def _compare(value, target, op) -> bool:
+    if value is _MISSING:
+        return False
+    candidates = value if isinstance(value, list) else [value]
+    target_key = _sort_key(target)
+    for candidate in candidates:
+        key = _sort_key(candidate)
+        if key[0] != target_key[0]:
+            continue
+        if op(key[1], target_key[1]):
+            return True
+    return False
+
+
+_TYPE_NAMES = {
+    'double': (float,), 'string': (str,), 'object': (dict,), 'array': (list,),
+    'objectId': (ObjectId,), 'bool': (bool,), 'date': (datetime,),
+    'int': (int,), 'long': (int,), 'number': (int, float), 'binData': (bytes,),
+}
+_TYPE_CODES = {1: 'double', 2: 'string', 3: 'object', 4: 'array', 5: 'binData',
+               7: 'objectId', 8: 'bool', 9: 'date', 10: 'null', 16: 'int', 18: 'long'}
+
+
+def _has_type(value, type_name) -> bool:
+    if isinstance(type_name, list):
+        return any(_has_type(value, t) for t in type_name)
+    type_name = _TYPE_CODES.get(type_name, type_name)
+    if value is _MISSING:
+        return False
+    if type_name == 'null':
+        return value is None
+    types = _TYPE_NAMES.get(type_name)
+    if types is None:
+        raise OperationFailure(f"unknown $type {type_name!r}", code=2)
+    if isinstance(value, bool) and type_name != 'bool':
+        return False
+    return isinstance(value, types)
+
+
+def _apply_operator(value, op: str, arg) -> bool:
+    if op == '$eq':
+        return _equals(value, arg)
+    if op == '$ne':
+        return not _equals(value, arg)
+    if op == '$gt':
+        return _compare(value, arg, lambda a, b: a > b)
+    if op == '$gte':
+        return _compare(value, arg, lambda a, b: a >= b)
+    if op == '$lt':
+        return _compare(value, arg, lambda a, b: a < b)
+    if op == '$lte':
+        return _compare(value, arg, lambda a, b: a <= b)
+    if op == '$in':
+        return any(_equals(value, target) for target in arg)
+    if op == '$nin':
+        return not any(_equals(value, target) for target in arg)
+    if op == '$exists':
+        return (value is not _MISSING) == bool(arg)
+    if op == '$type':
+        return _has_type(value, arg)
+    if op == '$not':
+        return not _match_value(value, arg)
+    raise OperationFailure(f"unknown operator: {op}", code=2)
+
+
+def _is_operator_dict(cond) -> bool:
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith('$') for k in cond)
+
+
+def _match_value(value, cond) -> bool:
+    if _is_operator_dict(cond):
+        return all(_apply_operator(value, op, arg) for op, arg in cond.items())
+    return _equals(value, cond)
+
+
+def matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    """True if ``doc`` satisfies the MongoDB filter ``query``."""
+    for key, cond in (query or {}).items():
+        if key == '$and':
+            if not all(matches(doc, q) for q in cond):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, q) for q in cond):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure(f"unknown top level operator: {key}", code=2)
+        elif not _match_value(_lookup(doc, key), cond):
+            return False
+    return True
+
+
+# --- updates ----------------------------------------------------------------
+
+def _set_path(doc, path: str, value) -> None:
+    parts = path.split('.')
+    current = doc
+    for part in parts[:-1]:
+        nxt = current.get(part) if isinstance(current, dict) else None
+        if not isinstance(nxt, dict):
+            nxt = {}
+            current[part] = nxt
+        current = nxt
+    current[parts[-1]] = value
+
+
+def _unset_path(doc, path: str) -> None:
+    parts = path.split('.')
+    current = doc
+    for part in parts[:-1]:
+        current = current.get(part) if isinstance(current, dict) else None
+        if not isinstance(current, dict):
+            return
+    current.pop(parts[-1], None)
+
+
+def _is_replacement(update: Dict[str, Any]) -> bool:
+    return not any(k.startswith('$') for k in update)
+
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any], inserting: bool = False) -> None:
+    if _is_replacement(update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == '$set':
+                _set_path(doc, path, copy.deepcopy(value))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set_path(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                current = _lookup(doc, path)
+                _set_path(doc, path, (0 if current is _MISSING or current is None else current) + value)
+            elif op in ('$min', '$max'):
+                current = _lookup(doc, path)
+                if current is _MISSING or (
+                    _sort_key(value) < _sort_key(current) if op == '$min' else _sort_key(value) > _sort_key(current)
+                ):
+                    _set_path(doc, path, copy.deepcopy(value))
+            elif op == '$push':
+                current = _lookup(doc, path)
+                items = list(current) if isinstance(current, list) else []
+                if isinstance(value, dict) and '$each' in value:
+                    items.extend(copy.deepcopy(value['$each']))
+                else:
+                    items.append(copy.deepcopy(value))
+                _set_path(doc, path, items)
+            else:
+                raise OperationFailure(f"unknown update operator: {op}", code=9)
+
+
+def _upsert_seed(query: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields an upsert copies from equality conditions of the filter."""
+    doc: Dict[str, Any] = {}
+    for key, cond in (query or {}).items():
+        if key == '$and':
+            for sub in cond:
+                for k, v in _upsert_seed(sub).items():
+                    doc[k] = v
+        elif key.startswith('$'):
+            continue
+        elif _is_operator_dict(cond):
+            if '$eq' in cond:
+                _set_path(doc, key, copy.deepcopy(cond['$eq']))
+        else:
+            _set_path(doc, key, copy.deepcopy(cond))
+    return doc
+
+
+def _project(doc: Dict[str, Any], projection) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(doc)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = [k for k, v in projection.items() if v and k != '_id']
+    if include:
+        result: Dict[str, Any] = {}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = copy.deepcopy(doc['_id'])
+        for field in include:
+            value = _lookup(doc, field)
+            if value is not _MISSING:
+                _set_path(result, field, copy.deepcopy(value))
+        return result
+    result = copy.deepcopy(doc)
+    for field, flag in projection.items():
+        if not flag:
+            _unset_path(result, field)
+    return result
+
+
+def _sort_spec(key_or_list, direction=None) -> List[Tuple[str, int]]:
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(k, d) for k, d in key_or_list]
+
+
+def _sorted(docs: List[Dict[str, Any]], spec: List[Tuple[str, int]]) -> List[Dict[str, Any]]:
+    for field, direction in reversed(spec):
+        docs = sorted(
+            docs,
+            key=lambda d: _sort_key(None if (v := _lookup(d, field)) is _MISSING else v),
+            reverse=direction == -1,
+        )
+    return docs
+
+
+# --- collections --------------------------------------------------------------
+
+class LocalCursor:
+    """Lazy result set with Motor's cursor chaining."""
+
+    def __init__(self, collection: 'LocalCollection', query, projection=None, sort=None, limit: int = 0, skip: int = 0):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort = _sort_spec(sort)
+        self._limit = limit or 0
+        self._skip = skip or 0
+        self._results: Optional[List[Dict[str, Any]]] = None
+        self._position = 0
+
+    def sort(self, key_or_list, direction=None) -> 'LocalCursor':
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def limit(self, limit: int) -> 'LocalCursor':
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> 'LocalCursor':
+        self._skip = skip
+        return self
+
+    def batch_size(self, _size: int) -> 'LocalCursor':
+        return self
+
+    def _evaluate(self) -> List[Dict[str, Any]]:
+        if self._results is None:
+            docs = self._collection._find_docs(self._query, self._sort, self._skip, self._limit)
+            self._results = [_project(d, self._projection) for d in docs]
+        return self._results
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Like Motor, consumes what it returns: the next call continues after it
+        results = self._evaluate()
+        end = self._position + length if length else len(results)
+        batch = results[self._position:end]
+        self._position += len(batch)
+        return batch
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        results = self._evaluate()
+        while self._position < len(results):
+            self._position += 1
+            yield results[self._position - 1]
+
+
+class LocalCollection:
+    """One collection of a local database."""
+
+    def __init__(self, database: 'LocalDatabase', name: str, docs: Iterable[Dict[str, Any]] = (), indexes: Iterable[Dict[str, Any]] = ()):
+        self.database = database
+        self.name = name
+        self._docs: Dict[Any, Dict[str, Any]] = {}
+        self._indexes: Dict[str, Dict[str, Any]] = {'_id_': {'key': [('_id', 1)]}}
+        self._unique: Dict[str, Dict[Any, Any]] = {}
+        for spec in indexes:
+            self._indexes[spec['name']] = spec
+            if spec.get('unique'):
+                self._unique[spec['name']] = {}
+        for doc in docs:
+            self._store(doc)
+
+    # internal helpers (synchronous, so every operation is atomic on the event loop)
+
+    def _unique_keys(self, doc: Dict[str, Any]):
+        for name in self._unique:
+            spec = self._indexes[name]
+            partial = spec.get('partialFilterExpression')
+            if partial and not matches(doc, partial):
+                continue
+            values = [_lookup(doc, field) for field, _ in spec['key']]
+            if spec.get('sparse') and all(v is _MISSING for v in values):
+                continue
+            yield name, tuple(_freeze(None if v is _MISSING else v) for v in values)
+
+    def _store(self, doc: Dict[str, Any], old: Optional[Dict[str, Any]] = None) -> None:
+        doc_key = _freeze(doc['_id'])
+        if old is None and doc_key in self._docs:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.name} index: _id_ dup key: {doc['_id']!r}", 11000
+            )
+        new_keys = list(self._unique_keys(doc))
+        for name, key in new_keys:
+            owner = self._unique[name].get(key)
+            if owner is not None and owner != doc_key:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {self.name} index: {name} dup key: {key!r}", 11000
+                )
+        if old is not None:
+            self._unindex(old)
+        for name, key in new_keys:
+            self._unique[name][key] = doc_key
+        self._docs[doc_key] = doc
+
+    def _unindex(self, doc: Dict[str, Any]) -> None:
+        for name, key in self._unique_keys(doc):
+            self._unique[name].pop(key, None)
+
+    def _remove(self, doc: Dict[str, Any]) -> None:
+        self._unindex(doc)
+        self._docs.pop(_freeze(doc['_id']), None)
+
+    def _find_docs(self, query, sort=None, skip: int = 0, limit: int = 0) -> List[Dict[str, Any]]:
+        if query and set(query) == {'_id'} and not _is_operator_dict(query['_id']):
+            doc = self._docs.get(_freeze(query['_id']))
+            docs = [doc] if doc is not None else []
+        else:
+            docs = [d for d in self._docs.values() if matches(d, query)]
+        if sort:
+            docs = _sorted(docs, sort)
+        if skip:
+            docs = docs[skip:]
+        if limit:
+            docs = docs[:abs(limit)]
+        return docs
+
+    def _insert(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        doc = copy.deepcopy(document)
+        self._store(doc)
+        return doc
+
+    def _update(self, query, update, upsert: bool, multi: bool, sort=None):
+        """Returns (matched, modified, upserted_id, changed docs, before image, after doc)."""
+        targets = self._find_docs(query, _sort_spec(sort), limit=0 if multi else 1)
+        changed, before = [], None
+        modified = 0
+        for doc in targets:
+            new_doc = copy.deepcopy(doc)
+            _apply_update(new_doc, update)
+            if before is None:
+                before = copy.deepcopy(doc)
+            if new_doc != doc:
+                self._store(new_doc, old=doc)
+                changed.append(new_doc)
+                modified += 1
+        if targets:
+            after = self._docs.get(_freeze(targets[0]['_id']))
+            return len(targets), modified, None, changed, before, after
+        if not upsert:
+            return 0, 0, None, [], None, None
+        new_doc = _upsert_seed(query) if not _is_replacement(update) else {}
+        _apply_update(new_doc, update, inserting=True)
+        if '_id' not in new_doc:
+            seed_id = _upsert_seed(query).get('_id')
+            new_doc['_id'] = seed_id if seed_id is not None else ObjectId()
+        self._store(new_doc)
+        return 0, 0, new_doc['_id'], [new_doc], None, new_doc
+
+    def _delete(self, query, multi: bool) -> List[Dict[str, Any]]:
+        targets = self._find_docs(query, limit=0 if multi else 1)
+        for doc in targets:
+            self._remove(doc)
+        return targets
+
+    async def _persist(self, upserts: List[Dict[str, Any]] = (), deletes: List[Dict[str, Any]] = ()) -> None:
+        if upserts or deletes:
+            await self.database.client.backend.write(
+                self.database.name, self.name, list(upserts), [d['_id'] for d in deletes]
+            )
+
+    # Motor API
+
+    def find(self, filter=None, projection=None, sort=None, limit: int = 0, skip: int = 0, **_kwargs) -> LocalCursor:
+        return LocalCursor(self, filter, projection, sort, limit, skip)
+
+    async def find_one(self, filter=None, projection=None, sort=None, **_kwargs) -> Optional[Dict[str, Any]]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        docs = self._find_docs(filter, _sort_spec(sort), limit=1)
+        return _project(docs[0], projection) if docs else None
+
+    async def count_documents(self, filter, limit: int = 0, skip: int = 0, **_kwargs) -> int:
+        return len(self._find_docs(filter, skip=skip, limit=limit))
+
+    async def estimated_document_count(self, **_kwargs) -> int:
+        return len(self._docs)
+
+    async def insert_one(self, document: Dict[str, Any], session=None, **_kwargs) -> InsertOneResult:
+        doc = self._insert(document)
+        await self._persist([doc])
+        return InsertOneResult(doc['_id'], True)
+
+    async def insert_many(self, documents, ordered: bool = True, session=None, **_kwargs) -> InsertManyResult:
+        result = await self.bulk_write([InsertOne(d) for d in documents], ordered=ordered)
+        return InsertManyResult([d['_id'] for d in documents if '_id' in d], result.acknowledged)
+
+    async def update_one(self, filter, update, upsert: bool = False, session=None, **_kwargs) -> UpdateResult:
+        matched, modified, upserted_id, changed, _, _ = self._update(filter, update, upsert, multi=False)
+        await self._persist(changed)
+        return UpdateResult(_raw_update(matched, modified, upserted_id), True)
+
+    async def update_many(self, filter, update, upsert: bool = False, session=None, **_kwargs) -> UpdateResult:
+        matched, modified, upserted_id, changed, _, _ = self._update(filter, update, upsert, multi=True)
+        await self._persist(changed)
+        return UpdateResult(_raw_update(matched, modified, upserted_id), True)
+
+    async def replace_one(self, filter, replacement, upsert: bool = False, session=None, **_kwargs) -> UpdateResult:
+        if not _is_replacement(replacement):
+            raise ValueError('replacement can not include $ operators')
+        return await self.update_one(filter, replacement, upsert=upsert)
+
+    async def find_one_and_update(
+        self,
+        filter,
+        update,
+        projection=None,
+        sort=None,
+        upsert: bool = False,
+        return_document=ReturnDocument.BEFORE,
+        session=None,
+        **_kwargs,
+    ) -> Optional[Dict[str, Any]]:
+        _, _, _, changed, before, after = self._update(filter, update, upsert, multi=False, sort=sort)
+        await self._persist(changed)
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return _project(doc, projection) if doc is not None else None
+
+    async def delete_one(self, filter, session=None, **_kwargs) -> DeleteResult:
+        removed = self._delete(filter, multi=False)
+        await self._persist(deletes=removed)
+        return DeleteResult({'n': len(removed)}, True)
+
+    async def delete_many(self, filter, session=None, **_kwargs) -> DeleteResult:
+        removed = self._delete(filter, multi=True)
+        await self._persist(deletes=removed)
+        return DeleteResult({'n': len(removed)}, True)
+
+    async def bulk_write(self, requests, ordered: bool = True, session=None, **_kwargs) -> BulkWriteResult:
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        errors = []
+        upserts: Dict[Any, Dict[str, Any]] = {}
+        deletes: Dict[Any, Dict[str, Any]] = {}
+        for index, op in enumerate(requests):
+            try:
+                if isinstance(op, InsertOne):
+                    doc = self._insert(op._doc)
+                    counts['nInserted'] += 1
+                    changed, removed = [doc], []
+                elif isinstance(op, (UpdateOne, UpdateMany, ReplaceOne)):
+                    matched, modified, upserted_id, changed, _, _ = self._update(
+                        op._filter, op._doc, op._upsert, multi=isinstance(op, UpdateMany)
+                    )
+                    counts['nMatched'] += matched
+                    counts['nModified'] += modified
+                    if upserted_id is not None:
+                        counts['nUpserted'] += 1
+                        counts['upserted'].append({'index': index, '_id': upserted_id})
+                    removed = []
+                elif isinstance(op, (DeleteOne, DeleteMany)):
+                    removed = self._delete(op._filter, multi=isinstance(op, DeleteMany))
+                    counts['nRemoved'] += len(removed)
+                    changed = []
+                else:
+                    raise TypeError(f"{op!r} is not a valid request")
+            except DuplicateKeyError as e:
+                errors.append({'index': index, 'code': 11000, 'errmsg': str(e), 'op': getattr(op, '_doc', None)})
+                if ordered:
+                    break
+                continue
+            for doc in changed:
+                key = _freeze(doc['_id'])
+                deletes.pop(key, None)
+                upserts[key] = doc
+            for doc in removed:
+                key = _freeze(doc['_id'])
+                upserts.pop(key, None)
+                deletes[key] = doc
+        await self._persist(list(upserts.values()), list(deletes.values()))
+        if errors:
+            raise BulkWriteError({**counts, 'writeErrors': errors, 'writeConcernErrors': []})
+        return BulkWriteResult(counts, True)
+
+    async def create_indexes(self, indexes, session=None, **_kwargs) -> List[str]:
+        names = []
+        for model in indexes:
+            spec = dict(model.document)
+            spec['key'] = list(spec['key'].items())
+            await self._create_index(spec)
+            names.append(spec['name'])
+        return names
+
+    async def create_index(self, keys, **kwargs) -> str:
+        from pymongo import IndexModel
+        return (await self.create_indexes([IndexModel(keys, **kwargs)]))[0]
+
+    async def _create_index(self, spec: Dict[str, Any]) -> None:
+        name = spec['name']
+        if name in self._indexes:
+            return
+        self._indexes[name] = spec
+        if spec.get('unique'):
+            self._unique[name] = {}
+            for doc_key, doc in self._docs.items():
+                for index_name, key in self._unique_keys(doc):
+                    if index_name != name:
+                        continue
+                    if key in self._unique[name]:
+                        del self._indexes[name]
+                        del self._unique[name]
+                        raise DuplicateKeyError(
+                            f"E11000 duplicate key error collection: {self.name} index: {name} dup key: {key!r}", 11000
+                        )
+                    self._unique[name][key] = doc_key
+        await self.database.client.backend.write_index(self.database.name, self.name, spec)
+
+    async def drop_index(self, name: str, session=None, **_kwargs) -> None:
+        if name == '_id_' or name not in self._indexes:
+            raise OperationFailure(f"index not found with name [{name}]", code=27)
+        del self._indexes[name]
+        self._unique.pop(name, None)
+        await self.database.client.backend.drop_index(self.database.name, self.name, name)
+
+    async def index_information(self, session=None) -> Dict[str, Dict[str, Any]]:
+        return {name: {**copy.deepcopy(spec), 'v': 2} for name, spec in self._indexes.items()}
+
+    def watch(self, *_args, **_kwargs):
+        raise OperationFailure('The $changeStream stage is only supported on replica sets', code=40573)
+
+
+def _raw_update(matched: int, modified: int, upserted_id) -> Dict[str, Any]:
+    raw = {'n': matched + (1 if upserted_id is not None else 0), 'nModified': modified}
+    if upserted_id is not None:
+        raw['upserted'] = upserted_id
+    return raw
+
+
+class LocalDatabase:
+    def __init__(self, client: 'LocalClient', name: str):
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, LocalCollection] = {}
+        self._preloaded = False
+
+    async def preload(self) -> None:
+        """Load every stored collection without blocking the event loop."""
+        stored = await self.client.backend.load_all(self.name)
+        for name, (docs, indexes) in stored.items():
+            if name not in self._collections:
+                self._collections[name] = LocalCollection(self, name, docs, indexes)
+        self._preloaded = True
+
+    def __getitem__(self, name: str) -> LocalCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            # After preload() a collection not loaded yet has nothing stored
+            docs, indexes = ([], []) if self._preloaded else self.client.backend.load(self.name, name)
+            collection = LocalCollection(self, name, docs, indexes)
+            self._collections[name] = collection
+        return collection
+
+    def get_collection(self, name: str) -> LocalCollection:
+        return self[name]
+
+    async def list_collection_names(self, **_kwargs) -> List[str]:
+        return sorted(set(self._collections) | set(await self.client.backend.collection_names(self.name)))
+
+    async def command(self, command, *_args, **_kwargs) -> Dict[str, Any]:
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == 'ping':
+            return {'ok': 1.0}
+        if name in ('hello', 'isMaster', 'ismaster'):
+            # Standalone: no setName, so no transactions
+            return {'ok': 1.0, 'isWritablePrimary': True, 'ismaster': True, 'maxWireVersion': 17}
+        raise OperationFailure(f"no such command: '{name}'", code=59)
+
+
+class LocalClient:
+    """Stands in for AsyncIOMotorClient."""
+
+    def __init__(self, backend: 'MemoryBackend'):
+        self.backend = backend
+        self._databases: Dict[str, LocalDatabase] = {}
+
+    def __getitem__(self, name: str) -> LocalDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = LocalDatabase(self, name)
+        return database
+
+    def get_database(self, name: str) -> LocalDatabase:
+        return self[name]
+
+    @property
+    def admin(self) -> LocalDatabase:
+        return self['admin']
+
+    def start_session(self, **_kwargs):
+        raise OperationFailure('Transaction numbers are only allowed on a replica set member or mongos', code=20)
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+# --- persistence --------------------------------------------------------------
+
+class MemoryBackend:
+    """Nothing is persisted."""
+
+    def load(self, db_name: str, collection: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        return [], []
+
+    async def load_all(self, db_name: str) -> Dict[str, Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+        return {}
+
+    async def collection_names(self, db_name: str) -> List[str]:
+        return []
+
+    async def write(self, db_name: str, collection: str, upserts, delete_ids) -> None:
+        return None
+
+    async def write_index(self, db_name: str, collection: str, spec: Dict[str, Any]) -> None:
+        return None
+
+    async def drop_index(self, db_name: str, collection: str, name: str) -> None:
+        return None
+
+    def close(self) -> None:
+        return None
+
+
+class SQLiteBackend(MemoryBackend):
+    """Documents as extended JSON rows of one SQLite file in WAL mode."""
+
+    def __init__(self, path: str):
+        self.path = path
+        # A single thread owns the connection and applies writes in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-storage')
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect).result()
+
+    def _connect(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            ' db TEXT NOT NULL, collection TEXT NOT NULL, id TEXT NOT NULL, doc TEXT NOT NULL,'
+            ' PRIMARY KEY (db, collection, id)) WITHOUT ROWID'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS indexes ('
+            ' db TEXT NOT NULL, collection TEXT NOT NULL, name TEXT NOT NULL, spec TEXT NOT NULL,'
+            ' PRIMARY KEY (db, collection, name)) WITHOUT ROWID'
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _dumps(value) -> str:
+        return json_util.dumps(value, json_options=_JSON_OPTIONS, ensure_ascii=False)
+
+    @staticmethod
+    def _loads(text: str):
+        return json_util.loads(text, json_options=_JSON_OPTIONS)
+
+    def _load(self, db_name: str, collection: str):
+        docs = [
+            self._loads(row[0]) for row in self._conn.execute(
+                'SELECT doc FROM documents WHERE db = ? AND collection = ?', (db_name, collection)
+            )
+        ]
+        indexes = []
+        for (spec_text,) in self._conn.execute(
+            'SELECT spec FROM indexes WHERE db = ? AND collection = ?', (db_name, collection)
+        ):
+            spec = self._loads(spec_text)
+            spec['key'] = [tuple(k) for k in spec['key']]
+            indexes.append(spec)
+        return docs, indexes
+
+    def load(self, db_name: str, collection: str):
+        return self._executor.submit(self._load, db_name, collection).result()
+
+    def _collection_names(self, db_name: str) -> List[str]:
+        rows = self._conn.execute(
+            'SELECT collection FROM documents WHERE db = ? UNION SELECT collection FROM indexes WHERE db = ?',
+            (db_name, db_name),
+        )
+        return [row[0] for row in rows]
+
+    async def collection_names(self, db_name: str) -> List[str]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._collection_names, db_name)
+
+    def _load_all(self, db_name: str):
+        return {name: self._load(db_name, name) for name in self._collection_names(db_name)}
+
+    async def load_all(self, db_name: str):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._load_all, db_name)
+
+    def _write(self, db_name: str, collection: str, upserts, delete_ids) -> None:
+        with self._conn:
+            if upserts:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO documents (db, collection, id, doc) VALUES (?, ?, ?, ?)',
+                    [(db_name, collection, self._dumps(d['_id']), self._dumps(d)) for d in upserts],
+                )
+            if delete_ids:
+                self._conn.executemany(
+                    'DELETE FROM documents WHERE db = ? AND collection = ? AND id = ?',
+                    [(db_name, collection, self._dumps(i)) for i in delete_ids],
+                )
+
+    async def write(self, db_name: str, collection: str, upserts, delete_ids) -> None:
+        # Serialize on the loop so later in-memory changes are not picked up
+        upserts = [copy.deepcopy(d) for d in upserts]
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._write, db_name, collection, upserts, list(delete_ids)
+        )
+
+    def _write_index(self, db_name: str, collection: str, spec: Dict[str, Any]) -> None:
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO indexes (db, collection, name, spec) VALUES (?, ?, ?, ?)',
+                (db_name, collection, spec['name'], self._dumps(spec)),
+            )
+
+    async def write_index(self, db_name: str, collection: str, spec: Dict[str, Any]) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write_index, db_name, collection, spec)
+
+    def _drop_index(self, db_name: str, collection: str, name: str) -> None:
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM indexes WHERE db = ? AND collection = ? AND name = ?',
+                (db_name, collection, name),
+            )
+
+    async def drop_index(self, db_name: str, collection: str, name: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._drop_index, db_name, collection, name)
+
+    def close(self) -> None:
+        def shutdown():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(shutdown).result()
+        self._executor.shutdown(wait=True)
+
+
+def open_local_client(backend: str, sqlite_path: str) -> LocalClient:
+    """Client for the ``sqlite`` or ``memory`` storage backend."""
+    if backend == 'sqlite':
+        logger.info(f"Using SQLite storage at {sqlite_path}")
+        return LocalClient(SQLiteBackend(sqlite_path))
+    if backend == 'memory':
+        logger.info("Using in-memory storage (nothing is persisted)")
+        return LocalClient(MemoryBackend())
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r} (expected mongo, sqlite or memory)")